@@ -0,0 +1,284 @@
+#!/usr/bin/python
+
+import sys
+import getopt
+import os
+import io
+import json
+import time
+import shutil
+import tempfile
+import platform
+import statistics
+import subprocess
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fabfile
+import workflow_validator
+import deploy_agent
+
+default_parameters = {
+    "actions": 200,
+    "chains": 20,
+    "pathsets": 50,
+    "parameters": 2000,
+    "tool_files": 500,
+    "tool_file_size": 64 << 10,
+    "submodules": 60,
+    "repeat": 3
+}
+
+#Synthetic workflows modeled on fast_test_workflow, actions are spread over independent chains that the end action fans in
+#Every action writes its own collection so the data flow stays acyclic however many actions there are
+def generate_workflow(base_dir, workflow_name, actions, chains, pathsets, parameters):
+    workflow_dir = os.path.join(base_dir, workflow_name)
+    xml_dir = os.path.join(workflow_dir, workflow_name)
+    os.makedirs(xml_dir)
+
+    with open(os.path.join(workflow_dir, 'Makefile'), 'w') as f:
+        f.write("WORKFLOW_NAME={0}\nTOOL_FOLDER_NAME={0}\nWORKFLOW_VERSION=release_1\n".format(workflow_name))
+
+    flow = ['<?xml version="1.0" encoding="ISO-8859-1" ?>', '<flow name="{}">'.format(workflow_name), '<object name="workflowParameters"/>']
+    flow.append('<action name="begin"><output port="flowParams" object="workflowParameters"/></action>')
+    for collection in range(actions):
+        flow.append('<collection name="collection_{}"/>'.format(collection))
+    binding = ['<?xml version="1.0" encoding="ISO-8859-1" ?>', '<binding>', '<bind action="begin" type="download"/>']
+    tool = ['<toolset>']
+    for pathset in range(pathsets):
+        tool.append('<pathSet base="synthetic_tool_{}/release_{}"><toolPath tool="step_{}" path="run.py"/></pathSet>'.format(pathset, pathset % 7, pathset))
+    tool.append('<pathSet base="$base"><pathVar name="step.script" path="step.py"/></pathSet>')
+
+    for action in range(actions):
+        source = "collection_{}".format(action - chains) if action >= chains else None
+        target = "collection_{}".format(action)
+        flow.append('<action name="step_{}">'.format(action))
+        flow.append('<input port="flowParams" object="workflowParameters"/>')
+        if source:
+            flow.append('<input port="previous" collection="{}"/>'.format(source))
+        flow.append('<output port="result" collection="{}"/>'.format(target))
+        flow.append('</action>')
+
+        binding.append('<bind action="step_{0}" tool="step_{0}">'.format(action))
+        binding.append('<inputAsRequirement port="flowParams" requirement="flowParams"/>')
+        if source:
+            binding.append('<inputAsRequirement port="previous" requirement="previous"/>')
+        binding.append('<productionToOutput port="result" production="result"/>')
+        binding.append('</bind>')
+
+        tool.append('<tool name="step_{}">'.format(action))
+        tool.append('<require name="flowParams" type="file"/><require name="previous" type="folder"/>')
+        tool.append('<produce name="result" type="folder"/>')
+        tool.append('<execution env="binary" argConvention="adhoc"><arg pathRef="step.script"/></execution>')
+        tool.append('</tool>')
+        if action >= pathsets:
+            tool.append('<pathSet base="synthetic_tool_{}/release_1"><toolPath tool="step_{}" path="run.py"/></pathSet>'.format(action % pathsets, action))
+
+    flow.append('<action name="end">')
+    for tail in range(max(0, actions - chains), actions):
+        flow.append('<input port="result_{}" collection="collection_{}"/>'.format(tail, tail))
+    flow.append('</action>')
+    flow.append('</flow>')
+    binding.append('<bind action="end" type="upload"/>')
+    binding.append('</binding>')
+    tool.append('</toolset>')
+
+    interface = ['<?xml version="1.0" encoding="ISO-8859-1" ?>', '<interface id="{}" version="1.0">'.format(workflow_name)]
+    interface.append('<workflow-id>{}</workflow-id>'.format(workflow_name.upper()))
+    interface.append('<workflow-label>{}</workflow-label>'.format(workflow_name))
+    interface.append('<!-- Parameter declarations -->')
+    interface.append('<parameters>')
+    for parameter in range(parameters):
+        interface.append('<parameter name="parameter_{0}" label="Parameter {0}"><default value="{0}"/><validator type="length" maximum="1000"/></parameter>'.format(parameter))
+    interface.append('</parameters>')
+    for block in range(parameters // 10):
+        interface.append('<block label="Block {0}"><row><cell><label><content>Parameter {0}</content></label></cell><cell><input type="text" parameter="parameter_{0}"/></cell></row></block>'.format(block))
+    interface.append('</interface>')
+
+    result = ['<?xml version="1.0" encoding="ISO-8859-1" ?>', '<interface id="{}">'.format(workflow_name)]
+    for collection in range(max(0, actions - chains), actions):
+        result.append('<view id="view_{0}" label="View {0}"><blockRef id="main" type="block_{0}"/></view>'.format(collection))
+        result.append('<block id="block_{0}" type="table"><data><source type="file" name="collection_{0}/"/></data></block>'.format(collection))
+    result.append('</interface>')
+
+    for component, lines in [('flow.xml', flow), ('binding.xml', binding), ('tool.xml', tool), ('input.xml', interface), ('result.xml', result)]:
+        with open(os.path.join(xml_dir, component), 'w') as f:
+            f.write('\n'.join(lines))
+
+    return xml_dir
+
+#Synthetic tool tree of text-like (compressible) files spread over a few folders
+def generate_tool_tree(tool_dir, file_count, file_size):
+    line = b"synthetic tool resource line with some repeated content 0123456789\n"
+    content = (line * (file_size // len(line) + 1))[:file_size]
+    for file_index in range(file_count):
+        folder = os.path.join(tool_dir, "folder_{}".format(file_index % 16))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "file_{}.txt".format(file_index)), 'wb') as f:
+            f.write(content[:-16] + "{:016d}".format(file_index).encode())
+
+#Sibling submodules for read_all_tools
+def generate_submodules(base_dir, count):
+    for submodule in range(count):
+        submodule_dir = os.path.join(base_dir, "submodule_{}".format(submodule))
+        os.makedirs(submodule_dir)
+        with open(os.path.join(submodule_dir, 'Makefile'), 'w') as f:
+            f.write("TOOL_FOLDER_NAME=synthetic_tool_{}\nWORKFLOW_VERSION=release_{}\n".format(submodule, submodule % 7))
+
+#Runs the stage repeat times, then once more under tracemalloc for the peak memory
+def time_stage(function, repeat):
+    seconds = []
+    for iteration in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": seconds, "median": statistics.median(seconds), "min": min(seconds), "peak_bytes": peak}
+
+class CountingSink(io.RawIOBase):
+    def __init__(self):
+        self.bytes_written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return len(data)
+
+def run_benchmarks(parameters, work_dir):
+    workflow_name = "synthetic_workflow"
+    xml_dir = generate_workflow(work_dir, workflow_name, parameters["actions"], parameters["chains"], parameters["pathsets"], parameters["parameters"])
+    tool_dir = os.path.join(work_dir, workflow_name, "tools", workflow_name)
+    generate_tool_tree(tool_dir, parameters["tool_files"], parameters["tool_file_size"])
+    generate_submodules(work_dir, parameters["submodules"])
+    output_dir = os.path.join(work_dir, "output")
+    os.makedirs(output_dir)
+    repeat = parameters["repeat"]
+
+    stages = {}
+
+    #Deploys rewrite into a fresh folder, overwriting the files of the previous iteration would time the filesystem instead
+    def rewrite_all(cache):
+        rewrite_dir = tempfile.mkdtemp(dir=output_dir)
+        for component in fabfile.workflow_components:
+            fabfile.rewrite_workflow_component(component, os.path.join(work_dir, workflow_name), workflow_name, workflow_name, "release_1", "Synthetic", "Synthetic description", rewrite_dir, cache=cache)
+
+    stages["rewrite_workflow_component"] = time_stage(lambda: rewrite_all(False), repeat)
+    stages["rewrite_workflow_component_cached"] = time_stage(lambda: rewrite_all(True), repeat)
+    stages["output_tool_dependencies"] = time_stage(lambda: fabfile.output_tool_dependencies(workflow_name, os.path.join(work_dir, workflow_name)), repeat)
+    stages["read_all_tools"] = time_stage(lambda: fabfile.read_all_tools(work_dir), repeat)
+
+    def validate():
+        workflow = workflow_validator.Workflow(os.path.join(xml_dir, "flow.xml"), os.path.join(xml_dir, "binding.xml"), os.path.join(xml_dir, "tool.xml"))
+        workflow.validate()
+
+    stages["workflow_validator"] = time_stage(validate, repeat)
+    stages["hash_tree"] = time_stage(lambda: fabfile.hash_tree(tool_dir), repeat)
+
+    for codec in ["none", "gzip", "parallel"]:
+        sink = CountingSink()
+
+        def pack():
+            sink.bytes_written = 0
+            fabfile.write_compressed_tool_archive(tool_dir, sink, (codec, 6))
+
+        stages["tar_{}".format(codec)] = time_stage(pack, repeat)
+        stages["tar_{}".format(codec)]["bytes"] = sink.bytes_written
+    stages["tar_parallel"]["peak_bytes_note"] = "excludes the worker processes"
+
+    archive_path = os.path.join(work_dir, "tools.tar.gz")
+    with open(archive_path, 'wb') as f:
+        fabfile.write_compressed_tool_archive(tool_dir, f, ("gzip", 6))
+    deploy_dir = os.path.join(work_dir, "deploy")
+
+    def execute_plan():
+        shutil.rmtree(deploy_dir, ignore_errors=True)
+        plan = fabfile.tool_plan(archive_path, os.path.join(deploy_dir, workflow_name, "release_1"), True)
+        #The archive is reused by every iteration
+        plan["cleanup"] = []
+        deploy_agent.execute_plan(plan)
+
+    stages["deploy_agent"] = time_stage(execute_plan, repeat)
+
+    return stages
+
+def read_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_filename):
+    with open(baseline_filename) as f:
+        baseline = json.load(f)
+    print("\n{:<36}{:>12}{:>12}{:>10}".format("stage", "baseline", "current", "ratio"))
+    for stage, result in results["stages"].items():
+        if stage not in baseline["stages"]:
+            continue
+        previous = baseline["stages"][stage]["median"]
+        print("{:<36}{:>11.4f}s{:>11.4f}s{:>9.2f}x".format(stage, previous, result["median"], result["median"] / previous if previous else float('inf')))
+
+def usage():
+    print("[--output results.json] [--compare baseline.json] [--keep] " + " ".join("[--{} {}]".format(key.replace('_', '-'), value) for key, value in default_parameters.items()))
+
+def main():
+    parameters = dict(default_parameters)
+    long_options = ["output=", "compare=", "keep", "help"] + ["{}=".format(key.replace('_', '-')) for key in default_parameters]
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", long_options)
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    output_filename = "benchmark_{}.json".format(time.strftime("%Y%m%d_%H%M%S"))
+    baseline_filename = None
+    keep = False
+    for opt, value in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit(0)
+        elif opt == "--output":
+            output_filename = value
+        elif opt == "--compare":
+            baseline_filename = value
+        elif opt == "--keep":
+            keep = True
+        else:
+            parameters[opt[2:].replace('-', '_')] = int(value)
+
+    work_dir = tempfile.mkdtemp(prefix="ccms_benchmark_")
+    try:
+        stages = run_benchmarks(parameters, work_dir)
+    finally:
+        if keep:
+            print("Synthetic workflows kept in {}".format(work_dir))
+        else:
+            shutil.rmtree(work_dir)
+
+    results = {
+        "revision": read_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "parameters": parameters,
+        "stages": stages
+    }
+
+    print("{:<36}{:>12}{:>14}".format("stage", "median", "peak memory"))
+    for stage, result in stages.items():
+        print("{:<36}{:>11.4f}s{:>11.1f} MB{}".format(stage, result["median"], result["peak_bytes"] / 1e6, " *" if stage == "tar_parallel" else ""))
+    print("* tracemalloc only sees this process, memory of the parallel gzip worker processes is not counted")
+
+    with open(output_filename, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Results saved to {}".format(output_filename))
+
+    if baseline_filename:
+        compare(results, baseline_filename)
+
+if __name__ == "__main__":
+    main()
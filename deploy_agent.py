@@ -0,0 +1,161 @@
+#!/usr/bin/python
+
+#Executes a deployment plan compiled by fabfile.py in one invocation, either on the server or against a local directory.
+#Only the standard library is used so it can be shipped to the server as is.
+
+import sys
+import os
+import json
+import time
+import base64
+import shutil
+import tarfile
+import traceback
+
+result_marker = "CCMS_DEPLOY_AGENT_RESULT"
+
+#Step kinds in execution order, cleanup always runs
+plan_steps = ["directories", "links", "archives", "files", "pointers", "permissions", "cleanup"]
+
+def make_directory(step):
+    os.makedirs(step["path"], exist_ok=True)
+
+#Hard links every file of source into destination, so unchanged files of a previous version share their storage
+def link_tree(step):
+    source = step["source"]
+    for root, dirs, files in os.walk(source):
+        destination_root = os.path.join(step["destination"], os.path.relpath(root, source))
+        os.makedirs(destination_root, exist_ok=True)
+        for name in files:
+            os.link(os.path.join(root, name), os.path.join(destination_root, name), follow_symlinks=False)
+        #Symlinks to directories are listed as dirs but linked like files
+        for name in list(dirs):
+            if os.path.islink(os.path.join(root, name)):
+                os.link(os.path.join(root, name), os.path.join(destination_root, name), follow_symlinks=False)
+                dirs.remove(name)
+
+#Existing files are replaced rather than written in place, they may be hard links shared with another version
+def extract_archive(step):
+    os.makedirs(step["destination"], exist_ok=True)
+    with tarfile.open(step["source"], "r:*") as tar:
+        for member in tar.getmembers():
+            path = os.path.join(step["destination"], member.name)
+            if not member.isdir() and os.path.lexists(path) and not os.path.isdir(path):
+                os.remove(path)
+        if hasattr(tarfile, "fully_trusted_filter"):
+            tar.extractall(step["destination"], filter="fully_trusted")
+        else:
+            tar.extractall(step["destination"])
+
+def copy_file(step):
+    destination = step["destination"]
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    #Written next to the destination and renamed so readers never see a partial file
+    temp_destination = "{}.ccms_{}".format(destination, os.getpid())
+    shutil.copy(step["source"], temp_destination)
+    os.replace(temp_destination, destination)
+
+#Points destination at source (relative to the destination's folder) by renaming a fresh symlink over it
+#Optional steps are skipped when the source does not exist
+def switch_pointer(step):
+    destination = step["destination"]
+    if not os.path.exists(os.path.join(os.path.dirname(destination), step["source"])):
+        if step.get("optional"):
+            return
+        raise FileNotFoundError(step["source"])
+    temp_destination = "{}.ccms_{}".format(destination, os.getpid())
+    os.symlink(step["source"], temp_destination)
+    os.replace(temp_destination, destination)
+
+#Optional steps are skipped when the path does not exist
+def set_permissions(step):
+    if step.get("optional") and not os.path.lexists(step["path"]):
+        return
+    mode = int(str(step["mode"]), 8)
+    os.chmod(step["path"], mode)
+    if step.get("recursive"):
+        for root, dirs, files in os.walk(step["path"]):
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                if not os.path.islink(path):
+                    os.chmod(path, mode)
+
+def remove_path(step):
+    if os.path.isdir(step["path"]) and not os.path.islink(step["path"]):
+        shutil.rmtree(step["path"])
+    elif os.path.lexists(step["path"]):
+        os.remove(step["path"])
+
+step_functions = {
+    "directories": make_directory,
+    "links": link_tree,
+    "archives": extract_archive,
+    "files": copy_file,
+    "pointers": switch_pointer,
+    "permissions": set_permissions,
+    "cleanup": remove_path
+}
+
+#Normalizes shorthand entries, a plain string is the path of the step
+def normalize_step(kind, step):
+    if isinstance(step, str):
+        return {"path": step}
+    return step
+
+def describe_step(step):
+    return step.get("path") or step.get("destination") or step.get("source")
+
+def execute_plan(plan):
+    start = time.time()
+    results = []
+    failed = False
+    for kind in plan_steps:
+        for step in plan.get(kind, []):
+            step = normalize_step(kind, step)
+            if failed and kind != "cleanup":
+                results.append({"kind": kind, "target": describe_step(step), "ok": False, "skipped": True})
+                continue
+            step_start = time.time()
+            try:
+                step_functions[kind](step)
+                results.append({"kind": kind, "target": describe_step(step), "ok": True, "seconds": time.time() - step_start})
+            except Exception as e:
+                results.append({"kind": kind, "target": describe_step(step), "ok": False, "seconds": time.time() - step_start, "error": "{}: {}".format(e.__class__.__name__, e)})
+                #Failed cleanup is reported but does not fail the deployment
+                if kind != "cleanup":
+                    failed = True
+    return {"ok": not failed, "steps": results, "seconds": time.time() - start}
+
+def encode_plan(plan):
+    return base64.b64encode(json.dumps(plan).encode()).decode()
+
+def decode_plan(encoded_plan):
+    return json.loads(base64.b64decode(encoded_plan.encode()).decode())
+
+#Finds the result line in output that may also contain shell noise
+def parse_result(output):
+    for line in reversed(output.splitlines()):
+        if line.startswith(result_marker):
+            return json.loads(line[len(result_marker):])
+    return None
+
+#Large plans are passed as @<file holding the encoded plan>, a single argument is limited to 128 KB
+def read_plan_argument(argument):
+    if argument.startswith("@"):
+        with open(argument[1:]) as f:
+            return decode_plan(f.read())
+    return decode_plan(argument)
+
+def main():
+    if len(sys.argv) != 2:
+        print("<base64 encoded json plan> | @<file with the encoded plan>")
+        sys.exit(2)
+    try:
+        result = execute_plan(read_plan_argument(sys.argv[1]))
+    except Exception:
+        result = {"ok": False, "steps": [], "error": traceback.format_exc()}
+    print("{} {}".format(result_marker, json.dumps(result)))
+    sys.exit(0 if result["ok"] else 1)
+
+if __name__ == "__main__":
+    main()
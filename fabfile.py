@@ -2,30 +2,184 @@ from fabric2 import Connection
 from fabric2 import task
 from fabric2 import config
 import os
+import sys
 import time
-from xml.etree import ElementTree as ET
 import uuid
 import glob
+import shutil
+import shlex
 import json
+import re
 import urllib.parse
 import io
+import base64
+import hashlib
+import threading
+import functools
+import inspect
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait, as_completed
+import atexit
+import codecs
+import socket
+from invoke import Context
+import paramiko
+from invoke.runners import Result
+from invoke.exceptions import UnexpectedExit, CommandTimedOut
 
 workflow_components = ['input.xml', 'binding.xml', 'flow.xml', 'result.xml', 'tool.xml']
+#Encoded plans longer than this are staged as a file instead of passed on the command line
+max_inline_plan = 64 << 10
+tool_manifest_name = '.ccms_deploy_manifest.json'
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'ccmsdeployments')
+tool_inventory_lock = threading.Lock()
+deploy_trace = None
+sessions = {}
+sessions_lock = threading.Lock()
+session_open_locks = {}
+bundle_format = 1
+bundle_tool_compression = ("gzip", 6)
+
+#Deployment profiling
+
+#Spans of local commands, remote commands and transfers, exported as Chrome trace-event JSON
+class DeployTrace:
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+        self.thread_ids = {}
+        self.origin = time.time()
+
+    def record(self, category, name, start, end, args):
+        with self.lock:
+            thread_id = self.thread_ids.setdefault(threading.get_ident(), len(self.thread_ids) + 1)
+            self.spans.append({"cat": category, "name": name, "start": start, "end": end, "tid": thread_id, "args": args})
+
+    def export(self, filename):
+        events = []
+        for span in self.spans:
+            events.append({
+                "name": span["name"],
+                "cat": span["cat"],
+                "ph": "X",
+                "ts": (span["start"] - self.origin) * 1e6,
+                "dur": (span["end"] - span["start"]) * 1e6,
+                "pid": 1,
+                "tid": span["tid"],
+                "args": {key: value for key, value in span["args"].items() if value is not None}
+            })
+        with open(filename, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def print_summary(self, limit = 15):
+        operations = [span for span in self.spans if span["cat"] != "task"]
+        print("\nSlowest operations:")
+        print("{:>10} {:>12} {:<10} {}".format("seconds", "MB/s", "category", "operation"))
+        for span in sorted(operations, key=lambda span: span["start"] - span["end"])[:limit]:
+            duration = span["end"] - span["start"]
+            rate = ""
+            if span["args"].get("bytes"):
+                rate = "{:.2f}".format(span["args"]["bytes"] / max(duration, 1e-6) / 1e6)
+            print("{:>10.3f} {:>12} {:<10} {}".format(duration, rate, span["cat"], span["name"][:100]))
+
+        print("\nTotals by category:")
+        for category in sorted(set(span["cat"] for span in operations)):
+            spans = [span for span in operations if span["cat"] == category]
+            total_bytes = sum(span["args"].get("bytes") or 0 for span in spans)
+            print("\t{}: {} operations, {:.3f}s, {:.1f} MB".format(category, len(spans), sum(span["end"] - span["start"] for span in spans), total_bytes / 1e6))
+
+#Yields a dict that the caller can add arguments to (e.g. bytes once they are known)
+@contextmanager
+def traced(category, name, **args):
+    start = time.time()
+    try:
+        yield args
+    finally:
+        if deploy_trace is not None:
+            deploy_trace.record(category, name, start, time.time(), args)
+
+#Tasks with a profile argument start a trace unless one is already running, and export it when they finish
+def profiled(function):
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        global deploy_trace
+        profile = signature.bind(*args, **kwargs).arguments.get("profile", False)
+        started = profile and deploy_trace is None
+        if started:
+            deploy_trace = DeployTrace()
+        try:
+            with traced("task", function.__name__):
+                return function(*args, **kwargs)
+        finally:
+            if started:
+                trace_filename = "deploy_trace_{}_{}.json".format(function.__name__, time.strftime("%Y%m%d_%H%M%S"))
+                deploy_trace.export(trace_filename)
+                deploy_trace.print_summary()
+                print("\nTrace written to {} (open in chrome://tracing or https://ui.perfetto.dev)".format(trace_filename))
+                deploy_trace = None
+    return wrapper
+
 
 @task
 def release_text(c, workflow_name):
-    base_dir = '.'
-    tools = read_all_tools('..')
-    dependencies = output_tool_dependencies(workflow_name, base_dir)
-    makefile = read_makefile(base_dir)
-    readme = 'README.md'
-    previous_readme_lines = []
+    write_release_text('.', workflow_name, read_all_tools('..'))
+
+#Regenerates the README of every workflow folder under base_dir, the tools index is built once and unchanged READMEs are left alone
+@task
+def release_text_all(c, base_dir='.'):
+    tools = read_all_tools(base_dir)
+    folders = []
+    for folder in sorted(glob.glob(os.path.join(base_dir, '*'))):
+        if 'CCMSDeployments' in folder or not os.path.isfile(os.path.join(folder, 'Makefile')):
+            continue
+        workflow_name = read_makefile(folder).get("WORKFLOW_NAME")
+        if workflow_name and os.path.isfile(os.path.join(folder, workflow_name, 'tool.xml')):
+            folders.append((folder, workflow_name))
+
+    def write_entry(entry):
+        try:
+            return write_release_text(entry[0], entry[1], tools)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=c.get("concurrency", 4)) as executor:
+        results = list(executor.map(write_entry, folders))
+
+    for (folder, workflow_name), result in zip(folders, results):
+        if isinstance(result, Exception):
+            print("{} FAILED: {}".format(folder, result))
+        elif result:
+            print("{} updated".format(os.path.join(folder, 'README.md')))
+    print("{} of {} READMEs updated".format(sum(1 for result in results if result is True), len(folders)))
+
+#Returns whether the README changed
+def write_release_text(folder, workflow_name, tools):
+    readme = os.path.join(folder, 'README.md')
+    previous_text = None
     if os.path.isfile(readme):
         with open(readme) as f:
-            for previous_readme_line in f:
-                previous_readme_lines.append(previous_readme_line)
-                if "CCMS_DEPLOYMENTS_HEADER_BREAK_ELEMENT_CAUTION_ANYTHING_ABOVE_WILL_BE_AUTOGENERATED" in previous_readme_line:
-                    previous_readme_lines = []
+            previous_text = f.read()
+    text = render_release_text(folder, workflow_name, tools, previous_text)
+    if text == previous_text:
+        return False
+    with open(readme, 'w') as w:
+        w.write(text)
+    return True
+
+def render_release_text(folder, workflow_name, tools, previous_text = None):
+    dependencies = output_tool_dependencies(workflow_name, folder)
+    makefile = read_makefile(folder)
+    previous_readme_lines = []
+    if previous_text:
+        for previous_readme_line in previous_text.splitlines(True):
+            previous_readme_lines.append(previous_readme_line)
+            if "CCMS_DEPLOYMENTS_HEADER_BREAK_ELEMENT_CAUTION_ANYTHING_ABOVE_WILL_BE_AUTOGENERATED" in previous_readme_line:
+                previous_readme_lines = []
+        #The blank line written after the break is not carried over, so rendering the same inputs twice gives the same README
+        if previous_readme_lines[:1] == ['\n'] and len(previous_readme_lines) < len(previous_text.splitlines(True)):
+            previous_readme_lines = previous_readme_lines[1:]
 
     version = makefile["WORKFLOW_VERSION"]
     name = makefile.get("WORKFLOW_LABEL")
@@ -59,27 +213,50 @@ def release_text(c, workflow_name):
 
         seen[dependency] = dependency_version
 
-    with open(readme, 'w') as w:
-        w.write('## {}\n\n'.format(name))
-        w.write('#### Version: {}\n\n'.format(version))
-        if description:
-            w.write('#### Description: \n{}\n\n'.format(description[1:-1]))
-        if len(dependency_text) > 0:
-            w.write('#### Dependencies: \n{}\n\n'.format("\n".join(dependency_text)))
-        w.write('_{}_\n\n'.format(update_text))
-        w.write('<data id=CCMS_DEPLOYMENTS_HEADER_BREAK_ELEMENT_CAUTION_ANYTHING_ABOVE_WILL_BE_AUTOGENERATED />\n\n')
-        for previous_readme_line in previous_readme_lines:
-            w.write(previous_readme_line)
-
+    w = io.StringIO()
+    w.write('## {}\n\n'.format(name))
+    w.write('#### Version: {}\n\n'.format(version))
+    if description:
+        w.write('#### Description: \n{}\n\n'.format(description[1:-1]))
+    if len(dependency_text) > 0:
+        w.write('#### Dependencies: \n{}\n\n'.format("\n".join(dependency_text)))
+    w.write('_{}_\n\n'.format(update_text))
+    w.write('<data id=CCMS_DEPLOYMENTS_HEADER_BREAK_ELEMENT_CAUTION_ANYTHING_ABOVE_WILL_BE_AUTOGENERATED />\n\n')
+    for previous_readme_line in previous_readme_lines:
+        w.write(previous_readme_line)
+    return w.getvalue()
+
+#Read from the git metadata rather than by running git, a detached HEAD, master or main (or no repository) gives None
 @task
 def read_branch(c, workflow_name):
-    branch_name = None
-    with io.StringIO() as f:
-        c.local('cd {} && git branch | grep \*'.format(workflow_name), out_stream = f)
-        branch = f.getvalue().replace('\n','').replace('* ','')
-        if not ('HEAD detached' in branch or 'master' in branch or 'main' in branch):
-            branch_name = branch
-    return branch_name
+    head = read_git_head(workflow_name)
+    if not head or not head.startswith('ref: refs/heads/'):
+        return None
+    branch = head[len('ref: refs/heads/'):]
+    if 'master' in branch or 'main' in branch:
+        return None
+    return branch
+
+#HEAD of the repository containing folder, submodules and worktrees have a .git file pointing at their git folder
+def read_git_head(folder):
+    folder = os.path.abspath(folder)
+    while True:
+        git_path = os.path.join(folder, '.git')
+        if os.path.isfile(git_path):
+            with open(git_path) as f:
+                gitdir = f.read().strip()
+            if gitdir.startswith('gitdir:'):
+                git_path = os.path.join(folder, gitdir[len('gitdir:'):].strip())
+        if os.path.isdir(git_path):
+            try:
+                with open(os.path.join(git_path, 'HEAD')) as f:
+                    return f.read().strip()
+            except IOError:
+                return None
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return None
+        folder = parent
 
 def read_makefile(workflow_name):
     params = {}
@@ -98,30 +275,40 @@ def update_workflow_from_makefile(c, workflow_name, subcomponents):
     update_all(c, params["WORKFLOW_VERSION"], params.get("WORKFLOW_NAME"), params.get("TOOL_FOLDER_NAME"), params.get("WORKLFLOW_LABEL"), params.get("WORKLFLOW_DESCRIPTION"), workflow_name, subcomponents=subcomponents)
 
 @task
-def update_all(c, workflow_version, workflow_name=None, tool_name=None, workflow_label=None, workflow_description=None, base_dir=".", subcomponents=None, force_update_string='yes'):
+@profiled
+def update_all(c, workflow_version, workflow_name=None, tool_name=None, workflow_label=None, workflow_description=None, base_dir=".", subcomponents=None, force_update_string='yes', profile=False):
     production = "production" in c
 
     if workflow_version == None:
         exit("A workflow cannot be deployed without a version.")
 
-    branch_name = read_branch(c, base_dir)
-    if branch_name and not production:
-        workflow_version = '{}+{}'.format(workflow_version, branch_name.replace(' ','_'))
+    workflow_version = branch_version(c, workflow_version, base_dir)
 
     if workflow_name:
         update_workflow_xml(c, workflow_name, tool_name, workflow_version, workflow_label, workflow_description, base_dir=base_dir, subcomponents=subcomponents, force_update_string=force_update_string)
     if tool_name:
         update_tools(c, tool_name, workflow_version, base_dir)
 
+    host = c.host if isinstance(c, Connection) else "localhost"
+
     if workflow_name:
-        server_url_base = "https://{}/ProteoSAFe/index.jsp?params=".format(c.host)
-        workflow_url = server_url_base + urllib.parse.quote(json.dumps({"workflow":workflow_name.upper(), "workflow_version":workflow_version}))
-        print("SUCCESS:\n\n{} updated at with version:\n\n{}\n\n".format(workflow_name, workflow_url))
+        print("SUCCESS:\n\n{} updated at with version:\n\n{}\n\n".format(workflow_name, workflow_url(host, workflow_name, workflow_version)))
+
+    if workflow_name and force_update_string == 'yes':
+        print("And default version :\n\n{}\n\n".format(workflow_url(host, workflow_name)))
 
-    if force_update_string == 'yes':
-        server_url_base = "https://{}/ProteoSAFe/index.jsp?params=".format(c.host)
-        workflow_url = server_url_base + urllib.parse.quote(json.dumps({"workflow":workflow_name.upper()}))
-        print("And default version :\n\n{}\n\n".format(workflow_url))
+#Versions deployed outside production carry the branch they were deployed from
+def branch_version(c, workflow_version, base_dir = '.'):
+    branch_name = read_branch(c, base_dir)
+    if branch_name and "production" not in c:
+        return '{}+{}'.format(workflow_version, branch_name.replace(' ','_'))
+    return workflow_version
+
+def workflow_url(host, workflow_name, workflow_version = None):
+    params = {"workflow":workflow_name.upper()}
+    if workflow_version:
+        params["workflow_version"] = workflow_version
+    return "https://{}/ProteoSAFe/index.jsp?params=".format(host) + urllib.parse.quote(json.dumps(params))
 
 @task
 def read_workflows_from_yml(c):
@@ -155,10 +342,375 @@ def read_all_tools(base_dir = '.'):
                 pass
     return all_tools
 
+#Builds the deployment DAG, tool folders come before the workflows whose tool.xml references them
+def build_deploy_graph(workflows_to_deploy, base_dir = '.'):
+    tools = read_all_tools(base_dir)
+    dependents = {index: set() for index in range(len(workflows_to_deploy))}
+    dependencies = {index: set() for index in range(len(workflows_to_deploy))}
+
+    entries_by_folder = {}
+    for index, (workflow, subcomponents) in enumerate(workflows_to_deploy):
+        entries_by_folder.setdefault(workflow, []).append(index)
+
+    #The same folder listed more than once is deployed in the order of the yml
+    for indices in entries_by_folder.values():
+        for previous, current in zip(indices, indices[1:]):
+            dependents[previous].add(current)
+            dependencies[current].add(previous)
+
+    #The tool.xml of a folder is in its WORKFLOW_NAME subfolder, tool only folders have none
+    for index, (workflow, subcomponents) in enumerate(workflows_to_deploy):
+        try:
+            xml_folder = read_makefile(os.path.join(base_dir, workflow)).get("WORKFLOW_NAME")
+        except OSError:
+            continue
+        if not xml_folder or not os.path.isfile(os.path.join(base_dir, workflow, xml_folder, 'tool.xml')):
+            continue
+        try:
+            tool_dependencies = output_tool_dependencies(xml_folder, os.path.join(base_dir, workflow))
+        except Exception:
+            continue
+        for (dependency, dependency_version) in tool_dependencies:
+            if dependency not in tools:
+                continue
+            local_version, tool_folder = tools[dependency]
+            tool_folder = os.path.relpath(tool_folder, base_dir)
+            if tool_folder == workflow:
+                continue
+            for tool_index in entries_by_folder.get(tool_folder, []):
+                dependents[tool_index].add(index)
+                dependencies[index].add(tool_index)
+
+    return dependencies, dependents
+
 @task
-def deploy_all(c):
-    for workflow, subcomponents in read_workflows_from_yml(c):
+@profiled
+def deploy_all(c, profile=False):
+    workflows_to_deploy = read_workflows_from_yml(c)
+    dependencies, dependents = build_deploy_graph(workflows_to_deploy)
+    concurrency = max(1, int(c.get("concurrency", 1)))
+
+    results = {}
+    remaining = {index: set(dependencies[index]) for index in dependencies}
+    ready = [index for index in remaining if not remaining[index]]
+
+    #Workers share the session's single ssh transport, each command gets its own channel
+    if isinstance(c, Connection):
+        get_session(c)
+
+    def deploy_entry(index):
+        workflow, subcomponents = workflows_to_deploy[index]
+        start = time.time()
         update_workflow_from_makefile(c, workflow, subcomponents)
+        return time.time() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        running = {}
+        while ready or running:
+            for index in ready:
+                running[executor.submit(deploy_entry, index)] = index
+            ready = []
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                try:
+                    results[index] = ("SUCCESS", "{:.1f}s".format(future.result()))
+                except BaseException as e:
+                    results[index] = ("FAILED", str(e) or e.__class__.__name__)
+
+                for dependent in sorted(dependents[index]):
+                    remaining[dependent].discard(index)
+                    if results[index][0] != "SUCCESS":
+                        skip_dependents(dependent, workflows_to_deploy[index][0], dependents, results)
+                    elif not remaining[dependent] and dependent not in results:
+                        ready.append(dependent)
+
+    print("\nDeployment summary:")
+    for index, (workflow, subcomponents) in enumerate(workflows_to_deploy):
+        status, detail = results.get(index, ("SKIPPED", "not scheduled"))
+        print("\t{} [{}] {}: {}".format(workflow, ",".join(subcomponents), status, detail))
+
+    failures = [index for index in results if results[index][0] != "SUCCESS"]
+    if failures:
+        exit("{} of {} deployments did not succeed.".format(len(failures), len(workflows_to_deploy)))
+
+def skip_dependents(index, failed_workflow, dependents, results):
+    if index in results:
+        return
+    results[index] = ("SKIPPED", "depends on {} which did not deploy".format(failed_workflow))
+    for dependent in dependents[index]:
+        skip_dependents(dependent, failed_workflow, dependents, results)
+
+#Deploys one workflow to the host named in each config, the XML bundle and tool archives are prepared once and pushed to every host at the same time
+@task
+@profiled
+def update_hosts(c, configs, workflow_version, workflow_name=None, tool_name=None, workflow_label=None, workflow_description=None, base_dir=".", subcomponents=None, force_update_string='yes', user=None, profile=False):
+    if workflow_version == None:
+        exit("A workflow cannot be deployed without a version.")
+    if not subcomponents:
+        subcomponents = workflow_components
+    force_update = force_update_string == 'yes'
+
+    config_paths = configs.split(',')
+    targets = [host_connection(c, config_path, user) for config_path in config_paths]
+    hosts = [target.host if isinstance(target, Connection) else "localhost" for target in targets]
+
+    #As in update_all, only non-production servers get the branch appended to the version
+    branch_name = read_branch(c, base_dir)
+    versions = []
+    for target in targets:
+        if branch_name and "production" not in target:
+            versions.append('{}+{}'.format(workflow_version, branch_name.replace(' ','_')))
+        else:
+            versions.append(workflow_version)
+
+    bundles = {}
+    prepared_tools = PreparedTools(os.path.join(base_dir, 'tools', tool_name)) if tool_name else None
+
+    def push(index):
+        target, host, version = targets[index], hosts[index], versions[index]
+        start = time.time()
+        if isinstance(target, Connection):
+            get_session(target)
+        if workflow_name:
+            install_workflow_bundle(target, bundles[version], workflow_name, version, subcomponents, force_update)
+            print("[{}] {} {} installed".format(host, workflow_name, version))
+        if tool_name:
+            install_tools(target, tool_name, version, prepared_tools.local_path, prepared=prepared_tools)
+            print("[{}] tools {} {} installed".format(host, tool_name, version))
+        return time.time() - start
+
+    results = {}
+    try:
+        if workflow_name:
+            for version in sorted(set(versions)):
+                bundles[version] = prepare_workflow_bundle(workflow_name, tool_name, version, workflow_label, workflow_description, base_dir, subcomponents)
+
+        #Each host is isolated, a failure on one does not stop the others
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            futures = {executor.submit(push, index): index for index in range(len(targets))}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    results[index] = ("SUCCESS", "{:.1f}s".format(future.result()))
+                except BaseException as e:
+                    results[index] = ("FAILED", str(e) or e.__class__.__name__)
+                print("[{}] {}: {}".format(hosts[index], *results[index]))
+    finally:
+        for bundle in bundles.values():
+            os.remove(bundle)
+        if prepared_tools:
+            prepared_tools.remove()
+
+    print("\nDeployment summary:")
+    for index, host in enumerate(hosts):
+        status, detail = results.get(index, ("SKIPPED", "not pushed"))
+        print("\t{} ({}) {}: {}".format(host, config_paths[index], status, detail))
+        if status == "SUCCESS" and workflow_name:
+            print("\t\t{}".format(workflow_url(host, workflow_name, versions[index])))
+            if force_update:
+                print("\t\t{}".format(workflow_url(host, workflow_name)))
+
+    failures = [index for index in results if results[index][0] != "SUCCESS"]
+    if len(results) < len(targets) or failures:
+        exit("{} of {} hosts were not updated.".format(len(targets) - len(results) + len(failures), len(targets)))
+
+#Connection to the host named in a config file, which is layered over the command line config like --config
+def host_connection(c, config_path, user = None):
+    host_config = c.config.clone()
+    host_config.set_runtime_path(config_path)
+    host_config.load_runtime()
+    if host_config.get("target") == "local":
+        return Context(config=host_config)
+    if "host" not in host_config:
+        exit("{} does not name the host to deploy to.".format(config_path))
+    return Connection(host_config["host"], user=user, config=host_config)
+
+#Prebuilt deployment bundles, the rewritten XML and the tool archive are built once per version and pushed to any host as is
+
+@task
+def build_bundle(c, workflow_version, workflow_name=None, tool_name=None, workflow_label=None, workflow_description=None, base_dir=".", subcomponents=None):
+    return build_deployment_bundle(c, workflow_version, workflow_name, tool_name, workflow_label, workflow_description, base_dir, subcomponents)
+
+@task
+@profiled
+def push_bundle(c, bundle, force_update_string='yes', profile=False):
+    local_temp_path = "/tmp/bundle_{}".format(str(uuid.uuid4()))
+    try:
+        manifest = open_deployment_bundle(bundle, local_temp_path)
+        install_deployment_bundle(c, manifest, local_temp_path, force_update_string == 'yes')
+    finally:
+        shutil.rmtree(local_temp_path, ignore_errors=True)
+
+    host = c.host if isinstance(c, Connection) else "localhost"
+    if manifest["workflow_name"]:
+        print("SUCCESS:\n\n{} updated at with version:\n\n{}\n\n".format(manifest["workflow_name"], workflow_url(host, manifest["workflow_name"], manifest["workflow_version"])))
+        if force_update_string == 'yes':
+            print("And default version :\n\n{}\n\n".format(workflow_url(host, manifest["workflow_name"])))
+
+#Bundles are named by a key over every input, an existing bundle with its checksum file is reused without any preprocessing
+def build_deployment_bundle(c, workflow_version, workflow_name = None, tool_name = None, workflow_label = None, workflow_description = None, base_dir = ".", subcomponents = None):
+    import tarfile
+    if workflow_version == None:
+        exit("A bundle cannot be built without a version.")
+    if not workflow_name and not tool_name:
+        exit("A bundle needs a workflow name, a tool name or both.")
+    subcomponents = (subcomponents or workflow_components) if workflow_name else []
+    tool_path = os.path.join(base_dir, 'tools', tool_name) if tool_name else None
+
+    with traced("local", "hash bundle inputs"):
+        tool_manifest = hash_tree(tool_path) if tool_name else None
+        key_hash = hashlib.sha256(json.dumps([bundle_format, workflow_name, tool_name, workflow_version, workflow_label, workflow_description, subcomponents, tool_manifest], sort_keys=True).encode())
+        for component in subcomponents:
+            key_hash.update(file_sha256(os.path.join(base_dir, workflow_name, component)).encode())
+        key = key_hash.hexdigest()
+
+    bundle_path = os.path.join(bundle_dir(c), "{}_{}_{}.tar".format(workflow_name or tool_name, workflow_version, key[:16]))
+    if os.path.isfile(bundle_path) and os.path.isfile(bundle_path + ".sha256"):
+        print("Using cached bundle {}".format(bundle_path))
+        return bundle_path
+
+    members = {}
+    if workflow_name:
+        members["workflow.tar"] = prepare_workflow_bundle(workflow_name, tool_name, workflow_version, workflow_label, workflow_description, base_dir, subcomponents)
+    if tool_name:
+        members["tools.tar.gz"] = pack_tool_archive(tool_path, bundle_tool_compression, manifest=tool_manifest)
+
+    manifest = {
+        "format": bundle_format,
+        "key": key,
+        "workflow_name": workflow_name,
+        "tool_name": tool_name,
+        "workflow_version": workflow_version,
+        "workflow_label": workflow_label,
+        "workflow_description": workflow_description,
+        "subcomponents": subcomponents,
+        "tool_compression": bundle_tool_compression,
+        "tool_manifest": tool_manifest,
+        "checksums": {name: file_sha256(path) for name, path in members.items()}
+    }
+
+    #Written under a temporary name, a bundle only counts as built once its checksum file exists
+    os.makedirs(bundle_dir(c), exist_ok=True)
+    temp_bundle_path = "{}.{}".format(bundle_path, uuid.uuid4())
+    with traced("local", "write bundle {}".format(bundle_path)), tarfile.open(temp_bundle_path, 'w') as tar:
+        manifest_bytes = json.dumps(manifest, indent=1, sort_keys=True).encode()
+        manifest_info = tarfile.TarInfo("manifest.json")
+        manifest_info.size = len(manifest_bytes)
+        manifest_info.mtime = int(time.time())
+        manifest_info.mode = 0o644
+        tar.addfile(manifest_info, io.BytesIO(manifest_bytes))
+        for name, path in members.items():
+            tar.add(path, arcname=name)
+    for path in members.values():
+        os.remove(path)
+    checksum = file_sha256(temp_bundle_path)
+    os.replace(temp_bundle_path, bundle_path)
+    with open(bundle_path + ".sha256", 'w') as f:
+        f.write("{}  {}\n".format(checksum, os.path.basename(bundle_path)))
+
+    print("Built bundle {}".format(bundle_path))
+    return bundle_path
+
+#Verifies the bundle and its members and unpacks them, the tool archive is also extracted for incremental deploys
+def open_deployment_bundle(bundle_path, local_temp_path):
+    import tarfile
+    try:
+        with open(bundle_path + ".sha256") as f:
+            expected_checksum = f.read().split()[0]
+    except (OSError, IndexError):
+        exit("{} has no checksum file, rebuild it with build-bundle.".format(bundle_path))
+    with traced("local", "verify bundle {}".format(bundle_path)):
+        if file_sha256(bundle_path) != expected_checksum:
+            exit("{} does not match its checksum.".format(bundle_path))
+
+    os.makedirs(local_temp_path)
+    with traced("local", "unpack bundle {}".format(bundle_path)):
+        with tarfile.open(bundle_path) as tar:
+            tar.extractall(local_temp_path)
+        with open(os.path.join(local_temp_path, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest.get("format") != bundle_format:
+            exit("{} was built by an incompatible version of fabfile.py.".format(bundle_path))
+        for name, checksum in manifest["checksums"].items():
+            if file_sha256(os.path.join(local_temp_path, name)) != checksum:
+                exit("{} in {} does not match its checksum.".format(name, bundle_path))
+        if manifest["tool_name"]:
+            with tarfile.open(os.path.join(local_temp_path, "tools.tar.gz")) as tar:
+                tar.extractall(os.path.join(local_temp_path, "tools"))
+    return manifest
+
+def install_deployment_bundle(c, manifest, local_temp_path, force_update):
+    if manifest["workflow_name"]:
+        install_workflow_bundle(c, os.path.join(local_temp_path, "workflow.tar"), manifest["workflow_name"], manifest["workflow_version"], manifest["subcomponents"], force_update)
+    if manifest["tool_name"]:
+        tools_path = os.path.join(local_temp_path, "tools")
+        prepared = PreparedTools(tools_path, manifest=manifest["tool_manifest"], full_archive=(os.path.join(local_temp_path, "tools.tar.gz"), tuple(manifest["tool_compression"])))
+        #Incremental and linked installs pack subsets of the tree, those archives are not part of the bundle
+        try:
+            install_tools(c, manifest["tool_name"], manifest["workflow_version"], tools_path, prepared=prepared)
+        finally:
+            prepared.remove()
+
+def bundle_dir(c):
+    if "bundles" in c and "dir" in c["bundles"]:
+        return os.path.expanduser(c["bundles"]["dir"])
+    return os.path.join(cache_dir, "bundles")
+
+#Tool versions under paths.tools that no deployed workflow (default or versions/*) references in its tool.xml pathSets
+@task
+def collect_tool_garbage(c, delete_string='no', min_age_days=7):
+    production = "production" in c
+    workflow_user = c["production"]["workflow_user"] if production else None
+    tool_user = c["production"]["tool_user"] if production else None
+
+    #Both scans are one command each, the pathSet bases are extracted on the server
+    result = run_as(c, "find {} -mindepth 2 -maxdepth 4 -name tool.xml -exec grep -ho 'base=\"[^\"]*\"' {{}} +".format(c["paths"]["workflows"]), workflow_user, hide=True, warn=True)
+    referenced = set(line.strip()[len('base="'):-1].strip('/') for line in result.stdout.splitlines() if line.strip().startswith('base="'))
+    #A wrong workflows path or unreadable folders must not make every tool version look unreferenced
+    if not referenced:
+        exit("No pathSets found in tool.xml files under {}, nothing is collected.".format(c["paths"]["workflows"]))
+
+    #One sh -c so that with sudo per command the find also runs as the tool user, errors are dropped as the shell merges them into the output
+    result = run_as(c, "sh -c 'cd {} && find . -mindepth 2 -maxdepth 2 -type d -printf \"%T@ %P\\n\" 2>/dev/null'".format(c["paths"]["tools"]), tool_user, hide=True, warn=True)
+    versions = {}
+    for line in result.stdout.splitlines():
+        modified, _, tool_version = line.strip().partition(' ')
+        try:
+            versions[tool_version] = float(modified)
+        except ValueError:
+            continue
+    #Versions in unreadable folders are left out, they are never collected
+    if not versions and result.exited != 0:
+        exit("Could not list {}: {}".format(c["paths"]["tools"], result.stdout.strip()))
+
+    #References may point below a version folder (tool/version/bin) or name a whole tool (tool)
+    def is_referenced(tool_version):
+        return any(reference == tool_version or reference.startswith(tool_version + '/') or tool_version.startswith(reference + '/') for reference in referenced)
+
+    cutoff = time.time() - float(min_age_days) * 86400
+    unreferenced = sorted(tool_version for tool_version, modified in versions.items() if modified < cutoff and not is_referenced(tool_version))
+    print("{} tool versions, {} referenced by {} pathSets, {} unreferenced and older than {} days".format(len(versions), len(versions) - len(unreferenced), len(referenced), len(unreferenced), min_age_days))
+    if not unreferenced:
+        return
+
+    sizes = {}
+    for start in range(0, len(unreferenced), 500):
+        batch = unreferenced[start:start + 500]
+        result = run_as(c, "du -sk {}".format(" ".join(shlex.quote(os.path.join(c["paths"]["tools"], tool_version)) for tool_version in batch)), tool_user, hide=True, warn=True)
+        for line in result.stdout.splitlines():
+            size, _, tool_path = line.strip().partition('\t')
+            if size.isdigit():
+                sizes[os.path.relpath(tool_path, c["paths"]["tools"])] = int(size) * 1024
+    for tool_version in unreferenced:
+        print("\t{:>10.1f} MB {}".format(sizes.get(tool_version, 0) / 1e6, tool_version))
+    print("{:.1f} MB in unreferenced tool versions".format(sum(sizes.values()) / 1e6))
+
+    if delete_string == 'yes':
+        remove_remote_files(c, c["paths"]["tools"], unreferenced, tool_user)
+        invalidate_tool_inventory(c)
+        print("Removed {} tool versions".format(len(unreferenced)))
 
 @task
 def read_dependencies(c, workflow_name, rewrite_string = 'no', base_dir = '.'):
@@ -169,20 +721,67 @@ def read_dependencies(c, workflow_name, rewrite_string = 'no', base_dir = '.'):
 
 @task
 def is_on_server(c, tool_name, tool_version):
-    tool_path = os.path.join(c["paths"]["tools"],tool_name, tool_version)
+    tool_path = os.path.join(tool_name, tool_version)
+    inventory = read_tool_inventory(c)
+
+    #The inventory lists <tool>/<version>, tools nested deeper (or any tool if the listing failed) are checked remotely
+    if inventory is not None:
+        top_level_path = '/'.join(tool_path.split('/')[:2])
+        if top_level_path not in inventory:
+            return False
+        if top_level_path == tool_path:
+            return True
 
     production = "production" in c
     production_user = c["production"]["workflow_user"] if production else None
 
-    on_server = False
-
-    if production_user:
-        on_server = c.sudo("test -e {}".format(tool_path), user=production_user, pty=True)
-    else:
-        on_server = c.run("test -e {}".format(tool_path))
+    on_server = run_as(c, "test -e {}".format(os.path.join(c["paths"]["tools"], tool_path)), production_user, warn=True)
 
     return not on_server.return_code
 
+#Listing of <tool> and <tool>/<version> under paths.tools as the workflow user, cached on disk for inventory.ttl seconds
+#A failed listing is not cached, None is returned instead
+def read_tool_inventory(c):
+    cache_path = tool_inventory_cache_path(c)
+    ttl = float(c["inventory"]["ttl"]) if "inventory" in c else 300
+    production_user = c["production"]["workflow_user"] if "production" in c else None
+
+    with tool_inventory_lock:
+        try:
+            if time.time() - os.path.getmtime(cache_path) < ttl:
+                with open(cache_path) as f:
+                    return set(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+        #One sh -c so that with sudo per command the cd and the find both run as the production user
+        result = run_as(c, "sh -c 'cd {} && find . -mindepth 1 -maxdepth 2'".format(c["paths"]["tools"]), production_user, hide=True, warn=True)
+        if result.exited != 0:
+            print("Could not list {}, checking tools one at a time: {}".format(c["paths"]["tools"], (result.stderr or result.stdout).strip()))
+            return None
+        inventory = set(line[2:] for line in result.stdout.splitlines() if line.startswith('./'))
+
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_cache_path = "{}.{}".format(cache_path, uuid.uuid4())
+        with open(temp_cache_path, 'w') as f:
+            json.dump(sorted(inventory), f)
+        os.replace(temp_cache_path, cache_path)
+
+    return inventory
+
+def invalidate_tool_inventory(c):
+    with tool_inventory_lock:
+        try:
+            os.remove(tool_inventory_cache_path(c))
+        except OSError:
+            pass
+
+def tool_inventory_cache_path(c):
+    host = c.host if isinstance(c, Connection) else "localhost"
+    production_user = c["production"]["workflow_user"] if "production" in c else None
+    key = hashlib.sha256("{}@{}:{}:{}".format(c.get("user"), host, c["paths"]["tools"], production_user).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "inventory_{}_{}.json".format(host, key))
+
 
 def output_updates(c, workflow_name = None, tool_name = None, base_dir = '.', tools = None, seen = {}, rewrite = False):
     updates = {}
@@ -207,10 +806,12 @@ def output_updates(c, workflow_name = None, tool_name = None, base_dir = '.', to
                         updates[dependency] = local_version
                         status = "{}->{}".format(version, local_version)
 
-                    if version and is_on_server(c, dependency, local_version):
+                    #Without a host only the local Makefiles and tool.xml are compared
+                    deployment_checked = isinstance(c, Connection) or is_local_target(c)
+                    if version and deployment_checked and is_on_server(c, dependency, local_version):
                         deployed = True
 
-                    deployed_str = " (deployed)" if deployed else " (needs deployment)"
+                    deployed_str = (" (deployed)" if deployed else " (needs deployment)") if deployment_checked else ""
 
                     # if rewrite:
                     #     if not deployed:
@@ -241,6 +842,7 @@ def output_updates(c, workflow_name = None, tool_name = None, base_dir = '.', to
             rewrite_tool_w_new_dependencies(workflow_name, updates, base_dir = base_dir)
 
 def output_tool_dependencies(workflow_name, base_dir = '.'):
+    from xml.etree import ElementTree as ET
     dependencies = []
     local = os.path.join(base_dir, workflow_name, 'tool.xml')
     tree = ET.parse(local)
@@ -258,6 +860,7 @@ def output_tool_dependencies(workflow_name, base_dir = '.'):
     return dependencies
 
 def rewrite_tool_w_new_dependencies(workflow_name, updates, rewrite = False, base_dir = '.'):
+    from xml.etree import ElementTree as ET
     changes_made = False
     dependencies = []
     local = os.path.join(base_dir, workflow_name, 'tool.xml')
@@ -285,118 +888,588 @@ def generate_manifest(c):
             flag = " (Tool only)"
         elif "TOOL_FOLDER_NAME" not in params:
             flag = " (Workflow only)"
-        print('{}{}, version: {}, last updated: {}'.format(workflow,flag,params['WORKFLOW_VERSION'],params['LAST_UPDATED']))
+        deployed = ""
+        if isinstance(c, Connection) and "TOOL_FOLDER_NAME" in params:
+            if is_on_server(c, params["TOOL_FOLDER_NAME"], params['WORKFLOW_VERSION']):
+                deployed = ", tools deployed"
+            else:
+                deployed = ", tools not deployed"
+        print('{}{}, version: {}, last updated: {}{}'.format(workflow,flag,params['WORKFLOW_VERSION'],params['LAST_UPDATED'],deployed))
+
+#Matrix of what is deployed on every host of configs, each host is listed with one command and all hosts at the same time
+@task
+def deployed_manifest(c, configs, user=None, output=None):
+    config_paths = configs.split(',')
+    targets = [host_connection(c, config_path, user) for config_path in config_paths]
+    hosts = [target.host if isinstance(target, Connection) else "localhost" for target in targets]
+    #Columns are per config, a host listed twice (e.g. two local targets) is told apart by its config
+    hosts = [host if hosts.count(host) == 1 else "{} ({})".format(host, config_path) for host, config_path in zip(hosts, config_paths)]
+
+    listings = {}
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = {executor.submit(read_deployed_versions, targets[index]): index for index in range(len(targets))}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                listings[index] = future.result()
+                print("[{}] {} workflows, {} tools".format(hosts[index], len(listings[index]["workflows"]), len(listings[index]["tools"])))
+            except BaseException as e:
+                print("[{}] FAILED: {}".format(hosts[index], str(e) or e.__class__.__name__))
+
+    manifest = {"hosts": [hosts[index] for index in sorted(listings)], "workflows": {}, "tools": {}}
+    for index in sorted(listings):
+        for workflow, deployed in listings[index]["workflows"].items():
+            manifest["workflows"].setdefault(workflow, {})[hosts[index]] = deployed
+        for tool, versions in listings[index]["tools"].items():
+            manifest["tools"].setdefault(tool, {})[hosts[index]] = versions
+
+    if output and output.endswith(".json"):
+        with open(output, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+    else:
+        text = deployed_manifest_tsv(manifest)
+        if output:
+            with open(output, 'w') as f:
+                f.write(text)
+        else:
+            print(text, end="")
+    if output:
+        print("Deployed versions of {} workflows and {} tools on {} hosts written to {}".format(len(manifest["workflows"]), len(manifest["tools"]), len(manifest["hosts"]), output))
+    if len(listings) < len(targets):
+        exit("{} of {} hosts could not be listed.".format(len(targets) - len(listings), len(targets)))
+
+#Default version (from the version attribute of the default input.xml) and versions/* of every workflow, and every tool version
+def read_deployed_versions(c):
+    listing = " ; ".join([
+        "{{ test -d {0} && test -d {1} || exit 3; }}".format(c["paths"]["workflows"], c["paths"]["tools"]),
+        "(cd {} && find . -mindepth 3 -maxdepth 3 -type d -path './*/versions/*' -printf 'V %P\\n')".format(c["paths"]["workflows"]),
+        "(cd {} && grep -Ho -m1 '<interface[^>]*>' */input.xml | sed 's/^/D /')".format(c["paths"]["workflows"]),
+        "(cd {} && find . -mindepth 2 -maxdepth 2 -type d -printf 'T %P\\n')".format(c["paths"]["tools"])
+    ])
+    result = run_as(c, listing, hide=True, warn=True)
+    if result.exited == 3:
+        exit("{} or {} does not exist".format(c["paths"]["workflows"], c["paths"]["tools"]))
+    deployed = {"workflows": {}, "tools": {}}
+    for line in result.stdout.splitlines():
+        kind, _, entry = line.strip().partition(' ')
+        if kind == "V" and entry.count('/') == 2:
+            workflow, _, version = entry.split('/')
+            deployed["workflows"].setdefault(workflow, {"default": None, "versions": []})["versions"].append(version)
+        elif kind == "D":
+            path, _, tag = entry.partition(':')
+            version = re.search(r'\sversion="([^"]*)"', tag)
+            deployed["workflows"].setdefault(os.path.dirname(path), {"default": None, "versions": []})["default"] = version.group(1) if version else None
+        elif kind == "T" and '/' in entry:
+            tool, _, version = entry.partition('/')
+            deployed["tools"].setdefault(tool, []).append(version)
+    for workflow in deployed["workflows"].values():
+        workflow["versions"].sort()
+    for versions in deployed["tools"].values():
+        versions.sort()
+    return deployed
+
+#One row per workflow or tool version, one column per host marking where it is deployed and where it is the default
+def deployed_manifest_tsv(manifest):
+    hosts = manifest["hosts"]
+    rows = ["\t".join(["kind", "name", "version"] + hosts)]
+    for workflow, per_host in sorted(manifest["workflows"].items()):
+        versions = set()
+        for deployed in per_host.values():
+            versions.update(deployed["versions"])
+            if deployed["default"]:
+                versions.add(deployed["default"])
+        for version in sorted(versions):
+            cells = []
+            for host in hosts:
+                deployed = per_host.get(host, {"default": None, "versions": []})
+                cells.append("default" if deployed["default"] == version else ("yes" if version in deployed["versions"] else ""))
+            rows.append("\t".join(["workflow", workflow, version] + cells))
+    for tool, per_host in sorted(manifest["tools"].items()):
+        for version in sorted(set(version for versions in per_host.values() for version in versions)):
+            rows.append("\t".join(["tool", tool, version] + ["yes" if version in per_host.get(host, []) else "" for host in hosts]))
+    return "\n".join(rows) + "\n"
+
+#Validates every workflow in the yml (or every folder with a flow.xml) in parallel, unchanged workflows come from the cache
+@task
+def validate_all(c, base_dir='.'):
+    import workflow_validator
+
+    if "workflows" in c:
+        folders = []
+        for workflow, subcomponents in read_workflows_from_yml(c):
+            params = read_makefile(os.path.join(base_dir, workflow))
+            if "WORKFLOW_NAME" in params:
+                folder = os.path.join(base_dir, workflow, params["WORKFLOW_NAME"])
+                if folder not in folders:
+                    folders.append(folder)
+    else:
+        folders = workflow_validator.findworkflowfolders(base_dir)
+
+    start = time.time()
+    results, validated = workflow_validator.validaterepository(folders)
+    valid = workflow_validator.printrepositoryresults(results)
+    print("Validated {} of {} workflows in {:.2f}s, the rest were cached".format(validated, len(folders), time.time() - start))
+    if not valid:
+        exit("Workflow validation failed.")
 
 @task
-def update_workflow_xml(c, workflow_name, tool_name, workflow_version, workflow_label, workflow_description, base_dir=".", subcomponents=None, force_update_string='yes'):
+@profiled
+def update_workflow_xml(c, workflow_name, tool_name, workflow_version, workflow_label, workflow_description, base_dir=".", subcomponents=None, force_update_string='yes', profile=False):
     if not subcomponents:
         subcomponents = workflow_components
 
-    force_update = force_update_string == 'yes'
-    production = "production" in c
-
-    production_user = c["production"]["workflow_user"] if production else None
+    local_bundle_path = prepare_workflow_bundle(workflow_name, tool_name, workflow_version, workflow_label, workflow_description, base_dir, subcomponents)
+    install_workflow_bundle(c, local_bundle_path, workflow_name, workflow_version, subcomponents, force_update_string == 'yes')
+    os.remove(local_bundle_path)
 
+#Rewrites and validates the components and bundles them into one tarball, nothing here depends on the server
+def prepare_workflow_bundle(workflow_name, tool_name, workflow_version, workflow_label, workflow_description, base_dir, subcomponents):
+    import tarfile
     local_temp_path = os.path.join("/tmp/{}_{}_{}".format(workflow_name, workflow_version, str(uuid.uuid4())))
-    c.local("mkdir -p {}".format(local_temp_path))
+    os.makedirs(local_temp_path)
 
-    for component in subcomponents:
-        rewrite_workflow_component(component, base_dir, workflow_name, tool_name, workflow_version, workflow_label, workflow_description, local_temp_path)
+    with traced("local", "rewrite {} components".format(workflow_name)):
+        for component in subcomponents:
+            rewrite_workflow_component(component, base_dir, workflow_name, tool_name, workflow_version, workflow_label, workflow_description, local_temp_path)
 
     #Performing Workflow Files Validation
     try:
-        validate_workflow_xml(local_temp_path)
+        with traced("local", "validate {}".format(workflow_name)):
+            validate_workflow_xml(local_temp_path)
     except:
         print("Validation Failed in Exception")
 
-    base_workflow_path = os.path.join(c["paths"]["workflows"], workflow_name, "versions")
+    local_bundle_path = "{}.tar".format(local_temp_path)
+    with traced("local", "bundle {} components".format(workflow_name)), tarfile.open(local_bundle_path, 'w') as tar:
+        for component in subcomponents:
+            tar.add(os.path.join(local_temp_path, component), arcname=component)
+    return local_bundle_path
+
+#All components go up in one tarball and are installed into the versioned (and default) folder by one command
+def install_workflow_bundle(c, local_bundle_path, workflow_name, workflow_version, subcomponents, force_update):
+    production = "production" in c
+    production_user = c["production"]["workflow_user"] if production else None
+
+    workflow_path = os.path.join(c["paths"]["workflows"], workflow_name)
     versioned_workflow_path = os.path.join(c["paths"]["workflows"], workflow_name, "versions", workflow_version)
 
-    if production_user:
-        c.sudo("mkdir -p {}".format(base_workflow_path), user=production_user, pty=True)
-        c.sudo("mkdir -p {}".format(versioned_workflow_path), user=production_user, pty=True)
-    else:
-        c.run("mkdir -p {}".format(base_workflow_path))
-        c.run("mkdir -p {}".format(versioned_workflow_path))
+    if use_agent(c):
+        bundle_path = stage_payload(c, local_bundle_path)
+        plan = workflow_plan(bundle_path, workflow_path, versioned_workflow_path, subcomponents, force_update, open_permissions=not production_user)
+        execute_plan(c, plan, production_user, payloads=[bundle_path])
+        return
 
-    for component in subcomponents:
-        # print(component)
-        if force_update:
-            update_workflow_component(c, local_temp_path, workflow_name, component, production_user=production_user) #Adding to active default version
-        update_workflow_component(c, local_temp_path, workflow_name, component, workflow_version=workflow_version, production_user=production_user) #Explicitly adding versioned
+    remote_bundle_path = "/tmp/{}_{}_{}.tar".format(workflow_name, workflow_version, str(uuid.uuid4()))
+    put_file(c, local_bundle_path, remote_bundle_path, preserve_mode=True)
 
+    #Like the per-file deploys did, every default component that exists is opened up, not just the ones deployed
+    default_components = " ".join(os.path.join(workflow_path, component) for component in workflow_components)
+
+    install_steps = ["mkdir -p {}".format(versioned_workflow_path), "tar -C {} -xf {}".format(versioned_workflow_path, remote_bundle_path)]
+    if force_update:
+        install_steps += pointer_commands(workflow_path, workflow_version, subcomponents)
     if not production_user:
-        c.run("chmod 777 {}".format(versioned_workflow_path))
-        c.run("chmod -R 777 {}".format(versioned_workflow_path))
-        for xml_filename in workflow_components:
-            c.run("chmod 777 {}".format(os.path.join(c["paths"]["workflows"], workflow_name, xml_filename)))
+        install_steps.append("chmod -R 777 {}".format(versioned_workflow_path))
+        install_steps.append("{{ chmod 777 {} 2>/dev/null || true; }}".format(default_components))
+        install_steps.append("rm {}".format(remote_bundle_path))
+
+    run_as(c, "sh -c '{}'".format(" && ".join(install_steps)), production_user)
 
+    if production_user:
+        run_as(c, "rm {}".format(remote_bundle_path))
+
+
+#Deploys once, then pushes each changed component or tool file over the kept open session as soon as it is saved
+@task
+def watch(c, workflow_version, workflow_name=None, tool_name=None, workflow_label=None, workflow_description=None, base_dir=".", force_update_string='no', interval=0.5):
+    if "production" in c:
+        exit("watch only deploys to debug servers (proteomics2, ccms-internal), not production.")
+
+    update_all(c, workflow_version, workflow_name, tool_name, workflow_label, workflow_description, base_dir, force_update_string=force_update_string)
+    workflow_version = branch_version(c, workflow_version, base_dir)
+
+    watched = {}
+    if workflow_name:
+        for component in workflow_components:
+            watched[os.path.join(base_dir, workflow_name, component)] = ("component", component)
+    tool_path = os.path.join(base_dir, 'tools', tool_name) if tool_name else None
+    versioned_workflow_path = os.path.join(c["paths"]["workflows"], workflow_name, "versions", workflow_version) if workflow_name else None
+    final_tool_path = os.path.join(c["paths"]["tools"], tool_name, workflow_version) if tool_name else None
+
+    snapshot = watch_snapshot(watched, tool_path)
+    local_temp_path = "/tmp/{}_{}_{}".format(workflow_name or tool_name, workflow_version, str(uuid.uuid4()))
+    os.makedirs(local_temp_path)
+    print("Watching {} for changes, Ctrl-C to stop".format(", ".join(filter(None, [workflow_name and os.path.join(base_dir, workflow_name), tool_path]))))
+    try:
+        while True:
+            time.sleep(float(interval))
+            current = watch_snapshot(watched, tool_path)
+            changed = [path for path in current if snapshot.get(path) != current[path]]
+            removed = [path for path in snapshot if path not in current]
+            snapshot = current
+            if not changed and not removed:
+                continue
+
+            start = time.time()
+            for path in changed:
+                if path in watched:
+                    component = watched[path][1]
+                    rewrite_workflow_component(component, base_dir, workflow_name, tool_name, workflow_version, workflow_label, workflow_description, local_temp_path)
+                    replace_file(c, os.path.join(local_temp_path, component), os.path.join(versioned_workflow_path, component))
+                else:
+                    replace_file(c, path, os.path.join(final_tool_path, os.path.relpath(path, tool_path)))
+            #The tool's hash manifest no longer matches the server, it goes so the next incremental deploy sends everything
+            if any(path not in watched for path in changed + removed):
+                stale_files = [os.path.relpath(path, tool_path) for path in removed if path not in watched]
+                remove_remote_files(c, final_tool_path, stale_files + [tool_manifest_name])
+            print("{} pushed {} changed and {} removed files in {:.2f}s".format(time.strftime("%H:%M:%S"), len(changed), len(removed), time.time() - start))
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    finally:
+        shutil.rmtree(local_temp_path)
+
+#Modification time and size of every watched component and tool file that exists
+def watch_snapshot(watched, tool_path = None):
+    snapshot = {}
+    paths = list(watched)
+    if tool_path:
+        for root, dirs, files in os.walk(tool_path):
+            paths += [os.path.join(root, name) for name in files]
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+#Replaces one file on a debug server, written next to it and renamed so the server never reads half of it
+def replace_file(c, local_path, remote_path):
+    if is_local_target(c):
+        os.makedirs(os.path.dirname(remote_path), exist_ok=True)
+        shutil.copy(local_path, remote_path + ".ccms")
+        os.chmod(remote_path + ".ccms", 0o777)
+        os.replace(remote_path + ".ccms", remote_path)
+        return
+    with traced("transfer", "replace {}".format(remote_path), bytes=os.path.getsize(local_path)):
+        get_session(c).put_replace(local_path, remote_path, 0o777)
+
+#Points the default workflow at an already deployed version, nothing is uploaded
+@task
+@profiled
+def rollback(c, workflow_name, workflow_version, profile=False):
+    set_default_version(c, workflow_name, workflow_version)
+
+#Makes a version deployed with --force-update-string no the default
+@task
+@profiled
+def promote(c, workflow_name, workflow_version, profile=False):
+    set_default_version(c, workflow_name, workflow_version)
+
+def set_default_version(c, workflow_name, workflow_version):
+    production = "production" in c
+    production_user = c["production"]["workflow_user"] if production else None
+
+    workflow_path = os.path.join(c["paths"]["workflows"], workflow_name)
+    versioned_workflow_path = os.path.join(workflow_path, "versions", workflow_version)
+
+    if run_as(c, "test -d {}".format(versioned_workflow_path), production_user, hide=True, warn=True).exited != 0:
+        exit("{} is not deployed, nothing to point the default workflow at.".format(versioned_workflow_path))
+
+    #Components the version was deployed without keep pointing where they did
+    if use_agent(c):
+        execute_plan(c, {"pointers": pointer_steps(workflow_path, workflow_version, workflow_components, optional=True)}, production_user)
+    else:
+        run_as(c, "sh -c '{}'".format(" && ".join(pointer_commands(workflow_path, workflow_version, workflow_components, optional=True))), production_user)
+
+    host = c.host if isinstance(c, Connection) else "localhost"
+    print("Default version of {} now points to {}:\n\n{}\n\n".format(workflow_name, workflow_version, workflow_url(host, workflow_name)))
 
 #Uploading the actual tools to the server
 @task
-def update_tools(c, workflow_name, workflow_version, base_dir="."):
+@profiled
+def update_tools(c, workflow_name, workflow_version, base_dir=".", profile=False):
+    install_tools(c, workflow_name, workflow_version, os.path.join(base_dir, 'tools', workflow_name))
+
+#Prepared tools (from a fan-out) share the manifest and packed archives with the other hosts
+def install_tools(c, workflow_name, workflow_version, local_path, prepared = None):
     production = "production" in c
     production_user = c["production"]["tool_user"] if production else None
 
     final_path = os.path.join(c["paths"]["tools"],workflow_name, workflow_version)
 
-    if production_user:
-        c.sudo("mkdir -p {}".format(final_path), user=production_user, pty=True)
-    else:
-        c.run("mkdir -p {}".format(final_path))
+    #In incremental mode only files whose hash differs from the deployed manifest are sent
+    #A new version can instead be hard linked against the previous one and only the difference sent
+    settings = transfer_settings(c)
+    manifest = None
+    files = None
+    link_from = None
+    deleted_files = []
+    if settings["incremental"] or settings["link_previous"]:
+        if prepared:
+            manifest = prepared.hash()
+        else:
+            with traced("local", "hash {}".format(local_path)):
+                manifest = hash_tree(local_path)
+        remote_manifest = read_remote_manifest(c, final_path)
+        if not remote_manifest and settings["link_previous"]:
+            link_from = find_previous_version(c, os.path.dirname(final_path), final_path, production_user)
+            if link_from:
+                remote_manifest = read_remote_manifest(c, link_from)
+                deleted_files = [relative_path for relative_path in sorted(remote_manifest) if relative_path not in manifest]
+        if settings["incremental"] or link_from:
+            files = changed_files(manifest, remote_manifest)
+            if link_from:
+                print("Linking {} against {}, sending {} of {} entries and removing {}".format(final_path, link_from, len(files), len(manifest), len(deleted_files)))
+            elif not files:
+                print("{} is already up to date on the server".format(final_path))
+                return
+
+    if use_agent(c):
+        compression = prepared.compression(c, files) if prepared else choose_compression(c, local_path, files)
+        if prepared:
+            local_archive_path = prepared.archive(compression, files)
+        else:
+            local_archive_path = pack_upload_archive(c, local_path, final_path, compression, files=files, manifest=manifest)
+        archive_path = stage_payload(c, local_archive_path)
+        if not prepared:
+            os.remove(local_archive_path)
+        plan = tool_plan(archive_path, final_path, open_permissions=not production_user, link_from=link_from, deleted_files=deleted_files)
+        execute_plan(c, plan, production_user, payloads=[archive_path])
+        invalidate_tool_inventory(c)
+        return
+
+    if link_from:
+        run_as(c, "sh -c 'mkdir -p {0} && cp -al {1}/. {0}/'".format(final_path, link_from), production_user)
+        remove_remote_files(c, final_path, deleted_files, production_user)
 
-    local_path = os.path.join(base_dir, 'tools', workflow_name)
+    run_as(c, "mkdir -p {}".format(final_path), production_user)
 
-    update_folder(c, local_path, final_path, production_user=production_user)
+    update_folder(c, local_path, final_path, production_user=production_user, files=files, manifest=manifest, prepared=prepared)
+    invalidate_tool_inventory(c)
 
     if not production_user:
-        c.run("chmod 777 {}".format(final_path))
-        c.run("chmod -R 777 {}".format(final_path))
+        run_as(c, "chmod 777 {}".format(final_path))
+        run_as(c, "chmod -R 777 {}".format(final_path))
+
+#Tool folder artifacts shared by every host of a fan-out, the tree is hashed and each distinct archive is packed only once
+#A bundle's prebuilt archive of the whole tree is used as is (whatever codec the host would pick) and left in place
+class PreparedTools:
+    def __init__(self, local_path, manifest = None, full_archive = None):
+        self.local_path = local_path
+        self.manifest = manifest
+        self.archives = {}
+        self.full_archive = full_archive
+        self.lock = threading.Lock()
+
+    #Incremental deploys to a host without the tool send every file, which is the full archive too
+    def is_full(self, files):
+        return files is None or (self.manifest is not None and len(files) == len(self.manifest))
+
+    def compression(self, c, files = None):
+        if self.full_archive and self.is_full(files):
+            return self.full_archive[1]
+        return choose_compression(c, self.local_path, files)
+
+    def hash(self):
+        with self.lock:
+            if self.manifest is None:
+                with traced("local", "hash {}".format(self.local_path)):
+                    self.manifest = hash_tree(self.local_path)
+            return self.manifest
+
+    def archive(self, compression, files = None):
+        if self.full_archive and self.is_full(files) and compression == self.full_archive[1]:
+            return self.full_archive[0]
+        key = (compression, tuple(files) if files is not None else None)
+        with self.lock:
+            if key not in self.archives:
+                self.archives[key] = pack_tool_archive(self.local_path, compression, files=files, manifest=self.manifest)
+            return self.archives[key]
+
+    def remove(self):
+        for archive_path in self.archives.values():
+            os.remove(archive_path)
+        self.archives = {}
+
+
+#The most recently deployed other version of the tool (by the time of its manifest), None for a tool's first version
+def find_previous_version(c, tool_path, final_path, production_user = None):
+    result = run_as(c, "ls -1t {} 2>/dev/null".format(os.path.join(tool_path, "*", tool_manifest_name)), production_user, hide=True, warn=True)
+    for line in result.stdout.splitlines():
+        version_path = os.path.dirname(line.strip())
+        if line.strip().endswith(tool_manifest_name) and version_path != os.path.normpath(final_path):
+            return version_path
+    return None
+
+def remove_remote_files(c, final_path, relative_paths, production_user = None, batch_size = 500):
+    for start in range(0, len(relative_paths), batch_size):
+        batch = relative_paths[start:start + batch_size]
+        run_as(c, "rm -rf {}".format(" ".join(shlex.quote(os.path.join(final_path, relative_path)) for relative_path in batch)), production_user)
 
 
 #Utility Functions
 
-def rewrite_workflow_component(component, base_dir, workflow_name, tool_name, workflow_version, workflow_label, workflow_description, local_temp_path):
+#Only the attributes and texts that change are spliced into the original bytes, so encoding declaration, comments and layout survive
+#Rewritten components are cached by a hash of the source and of everything written into it
+def rewrite_workflow_component(component, base_dir, workflow_name, tool_name, workflow_version, workflow_label, workflow_description, local_temp_path, cache = True):
     local = os.path.join(base_dir, workflow_name, component)
     temp = os.path.join(local_temp_path,component)
-    tree = ET.parse(local)
-    root = tree.getroot()
+    with open(local, 'rb') as f:
+        source = f.read()
+
+    key = hashlib.sha256(json.dumps([component_rewrite_hash(), component, workflow_name, tool_name, workflow_version, workflow_label, workflow_description]).encode() + source).hexdigest()
+    cache_path = os.path.join(cache_dir, "components", "{}.xml".format(key))
+    if cache and os.path.isfile(cache_path):
+        os.utime(cache_path)
+        shutil.copy(cache_path, temp)
+        return
+
+    rewritten = splice_workflow_component(component, source, workflow_name, tool_name, workflow_version, workflow_label, workflow_description)
+    with open(temp, 'wb') as f:
+        f.write(rewritten)
+
+    if cache:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_cache_path = "{}.{}".format(cache_path, uuid.uuid4().hex[:8])
+        shutil.copy(temp, temp_cache_path)
+        os.replace(temp_cache_path, cache_path)
+        prune_component_cache(os.path.dirname(cache_path))
+
+#Part of the component cache key, so output cached by an older version of the rewrite is not deployed
+@functools.lru_cache(maxsize=None)
+def component_rewrite_hash():
+    functions = [rewrite_workflow_component, splice_workflow_component, scan_xml_elements, xml_tag_end, set_xml_attribute, set_xml_text, insert_xml_child, escape_xml]
+    source = "".join(inspect.getsource(function) for function in functions) + repr(xml_attribute_pattern.pattern)
+    return hashlib.sha256(source.encode()).hexdigest()
+
+def splice_workflow_component(component, source, workflow_name, tool_name, workflow_version, workflow_label, workflow_description):
+    root, children, encoding = scan_xml_elements(source, ['workflow-id', 'workflow-label', 'pathSet'])
+    edits = []
     if component in ['input.xml','result.xml']:
-        root.set('id', workflow_name)
-        root.set('version', workflow_version)
+        edits.append(set_xml_attribute(source, root, 'id', workflow_name))
+        edits.append(set_xml_attribute(source, root, 'version', workflow_version))
         if component in ['input.xml']:
-            for path in root.findall('workflow-id'):
-                path.text = workflow_name.upper()
-            for path in root.findall('workflow-label'):
-                if workflow_label:
-                    path.text = workflow_label
+            for element in children:
+                if element["name"] == 'workflow-id':
+                    edits.append(set_xml_text(source, element, workflow_name.upper()))
+                elif element["name"] == 'workflow-label' and workflow_label:
+                    edits.append(set_xml_text(source, element, workflow_label))
             if workflow_description is not None:
-                description_block = ET.Element("block")
-                root.insert(0, description_block)
-                description_block.attrib["label"] = "Workflow Description"
-                description_row = ET.SubElement(description_block, "row")
-                description_cell = ET.SubElement(description_row, "cell")
-                description_label = ET.SubElement(description_cell, "label")
-                description_label.attrib["prefix"] = "false"
-                description_content = ET.SubElement(description_label, "content")
-                description_content.text = '<div style="5px;padding:1px; border:2px;margin-left:8%;margin-right:8%;text-align:left">\
+                description_content = '<div style="5px;padding:1px; border:2px;margin-left:8%;margin-right:8%;text-align:left">\
                     <br><strong>{}</strong> \
                     <hr style="margin-top:5px;margin-bottom:5px"> \
                     {} \
                     <hr style="margin-top:5px;margin-bottom:5px"> \
                     <small>Workflow version {} </small> \
                     </div>'.format(workflow_label if workflow_label else workflow_name.upper(), workflow_description, workflow_version)
+                description_block = '<block label="Workflow Description"><row><cell><label prefix="false"><content>{}</content></label></cell></row></block>'.format(escape_xml(description_content))
+                edits.append(insert_xml_child(source, root, description_block))
 
     elif component in ['flow.xml']:
-        root.set('name', workflow_name)
+        edits.append(set_xml_attribute(source, root, 'name', workflow_name))
     elif component in ['tool.xml']:
-        for path in root.findall('pathSet'):
-            if '$base' in path.get('base'):
+        for element in children:
+            if element["name"] == 'pathSet' and '$base' in element["attributes"].get('base', ''):
                 if tool_name:
-                    path.set('base',path.get('base').replace('$base',os.path.join(tool_name,workflow_version)))
+                    edits.append(set_xml_attribute(source, element, 'base', element["attributes"]['base'].replace('$base',os.path.join(tool_name,workflow_version))))
                 else:
                     exit("Cannot rewrite tool.xml without specifying tool name.")
-    tree.write(temp)
+
+    #Edits are (start, end, text) byte ranges, an insertion sorts before a replacement starting at the same offset
+    output = []
+    position = 0
+    for edit_start, edit_end, text in sorted(edits, key=lambda edit: (edit[0], edit[1])):
+        output.append(source[position:edit_start])
+        output.append(text.encode(encoding, 'xmlcharrefreplace'))
+        position = edit_end
+    output.append(source[position:])
+    return b"".join(output)
+
+#Byte offsets of the root element and of its children named in child_names, from one expat pass that also checks the XML is well formed
+def scan_xml_elements(source, child_names):
+    import xml.parsers.expat
+    parser = xml.parsers.expat.ParserCreate()
+    elements = []
+    open_elements = []
+    encoding = ['utf-8']
+
+    def xml_declaration(version, declared_encoding, standalone):
+        if declared_encoding:
+            encoding[0] = declared_encoding
+
+    def start_element(name, attributes):
+        element = None
+        if not open_elements or (len(open_elements) == 1 and name in child_names):
+            element = {"name": name, "attributes": attributes, "start": parser.CurrentByteIndex}
+            elements.append(element)
+        open_elements.append(element)
+
+    def end_element(name):
+        element = open_elements.pop()
+        if element:
+            element["close"] = parser.CurrentByteIndex
+
+    parser.XmlDeclHandler = xml_declaration
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.Parse(source, True)
+
+    for element in elements:
+        element["end"] = xml_tag_end(source, element["start"])
+        element["empty"] = source[element["end"] - 2:element["end"]] == b"/>"
+    return elements[0], elements[1:], encoding[0]
+
+def xml_tag_end(source, start):
+    quote = None
+    for index in range(start, len(source)):
+        character = source[index]
+        if quote:
+            if character == quote:
+                quote = None
+        elif character in b"\"'":
+            quote = character
+        elif character == ord('>'):
+            return index + 1
+    raise ValueError("Unterminated tag at byte {}".format(start))
+
+xml_attribute_pattern = re.compile(rb"""\s([^\s=/>]+)\s*=\s*("[^"]*"|'[^']*')""")
+
+def set_xml_attribute(source, element, name, value):
+    quoted_value = '"{}"'.format(escape_xml(value, attribute=True))
+    for match in xml_attribute_pattern.finditer(source, element["start"] + 1 + len(element["name"]), element["end"]):
+        if match.group(1).decode() == name:
+            return (match.start(2), match.end(2), quoted_value)
+    position = element["end"] - (2 if element["empty"] else 1)
+    return (position, position, ' {}={}'.format(name, quoted_value))
+
+def set_xml_text(source, element, text):
+    if element["empty"]:
+        return (element["end"] - 2, element["end"], '>{}</{}>'.format(escape_xml(text), element["name"]))
+    return (element["end"], element["close"], escape_xml(text))
+
+def insert_xml_child(source, element, markup):
+    if element["empty"]:
+        return (element["end"] - 2, element["end"], '>{}</{}>'.format(markup, element["name"]))
+    return (element["end"], element["end"], markup)
+
+def escape_xml(text, attribute = False):
+    text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    if attribute:
+        text = text.replace('"', "&quot;").replace("\n", "&#10;")
+    return text
+
+#Keeps the most recently used rewritten components
+def prune_component_cache(folder, limit = 1000):
+    entries = [os.path.join(folder, name) for name in os.listdir(folder) if name.endswith(".xml")]
+    if len(entries) <= limit:
+        return
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for path in entries[limit:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
 def validate_workflow_xml(local_temp_path):
     import workflow_validator
@@ -408,57 +1481,700 @@ def validate_workflow_xml(local_temp_path):
     workflow_obj = workflow_validator.Workflow(flow_path, binding_path, tool_path)
     workflow_obj.validate()
 
-    print(workflow_obj.printerrors())
+    workflow_obj.printerrors()
 
 
-#TODO: Validate that the xml is also a valid workflow
-def update_workflow_component(c, local_temp_path, workflow_filename, component, workflow_version=None, production_user=None):
-    local = os.path.join(local_temp_path,component)
+#TODO: update this to work with rsync
+def update_folder(c, local_path, final_path, production_user = None, files = None, manifest = None, prepared = None):
+    remote_temp_path = os.path.join("/tmp/{}_{}".format(local_path.replace("/", "_"), str(uuid.uuid4())))
+    compression = prepared.compression(c, files) if prepared else choose_compression(c, local_path, files)
+    extract_flags = "-xf" if compression[0] == "none" else "-xzf"
 
-    if workflow_version:
-        server = os.path.join(c["paths"]["workflows"], workflow_filename, "versions", workflow_version, component)
+    #Prepared archives are uploaded even in stream mode so the tree is not tarred again for every host
+    if transfer_settings(c)["method"] == "stream" and not prepared:
+        #Tar is produced and extracted on the fly over the ssh channel, nothing is staged as a tarball
+        stream_tool_archive(c, local_path, remote_temp_path, compression, files=files, manifest=manifest)
     else:
-        server = os.path.join(c["paths"]["workflows"], workflow_filename, component)
+        #Tar up local folder and upload to temporary space on server and untar
+        if prepared:
+            local_temp_path = prepared.archive(compression, files)
+        else:
+            local_temp_path = pack_upload_archive(c, local_path, final_path, compression, files=files, manifest=manifest)
+        extension = ".tar" if compression[0] == "none" else ".tar.gz"
+        remote_temp_tar_path = os.path.join("/tmp/{}_{}{}".format(local_path.replace("/", "_"), str(uuid.uuid4()), extension))
+        upload_file(c, local_temp_path, remote_temp_tar_path)
+        if not prepared:
+            os.remove(local_temp_path)
 
-    update_file(c, local, server, production_user=production_user)
+        run_as(c, "mkdir {}".format(remote_temp_path))
+        run_as(c, "tar -C {} {} {}".format(remote_temp_path, extract_flags, remote_temp_tar_path))
 
+        if os.path.split(os.path.normpath(remote_temp_tar_path))[0] == '/tmp':
+            run_as(c, 'rm {}'.format(remote_temp_tar_path))
 
+    run_as(c, 'rsync -rlptD {}/ {}'.format(remote_temp_path, final_path), production_user)
 
-#Update File
-def update_file(c, local_path, final_path, production_user = None):
-    if production_user:
-        remote_temp_path = os.path.join("/tmp/{}_{}".format(local_path.replace("/", "_"), str(uuid.uuid4())))
-        c.put(local_path, remote_temp_path, preserve_mode=True)
-        c.sudo('cp {} {}'.format(remote_temp_path, final_path), user=production_user, pty=True)
-        if os.path.split(os.path.normpath(remote_temp_path))[0] == '/tmp':
-            c.run('rm {}'.format(remote_temp_path))
-    else:
+    if os.path.split(os.path.normpath(remote_temp_path))[0] == '/tmp':
+        run_as(c, 'rm -rf {}'.format(remote_temp_path))
+
+def pack_tool_archive(local_path, compression, files = None, manifest = None, local_temp_path = None):
+    extension = ".tar" if compression[0] == "none" else ".tar.gz"
+    if local_temp_path is None:
+        local_temp_path = os.path.join("/tmp/{}_{}{}".format(local_path.replace("/", "_"), str(uuid.uuid4()), extension))
+    with traced("local", "pack {}".format(local_path), codec=compression[0]) as span, open(local_temp_path, 'wb') as f:
+        write_compressed_tool_archive(local_path, f, compression, files=files, manifest=manifest)
+        span["bytes"] = f.tell()
+    return local_temp_path
+
+#Resumable uploads keep their archive under a name derived from what it holds, so a retried deploy uploads the same bytes without packing again
+def pack_upload_archive(c, local_path, final_path, compression, files = None, manifest = None):
+    if not transfer_settings(c)["resumable"]:
+        return pack_tool_archive(local_path, compression, files=files, manifest=manifest)
+    host = c.host if isinstance(c, Connection) else "localhost"
+    #Keyed on the content too, a tool edited after an interrupted upload must not get the old archive
+    content = manifest if manifest is not None else hash_tree(local_path)
+    key = hashlib.sha256(json.dumps([host, final_path, compression, files, content], sort_keys=True).encode()).hexdigest()[:32]
+    archive_path = os.path.join(cache_dir, "uploads", "{}{}".format(key, ".tar" if compression[0] == "none" else ".tar.gz"))
+    if os.path.isfile(archive_path):
+        print("Reusing {} from an interrupted upload".format(archive_path))
+        return archive_path
+    os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+    temp_archive_path = "{}.{}".format(archive_path, uuid.uuid4())
+    pack_tool_archive(local_path, compression, files=files, manifest=manifest, local_temp_path=temp_archive_path)
+    os.replace(temp_archive_path, archive_path)
+    return archive_path
+
+def stream_tool_archive(c, local_path, remote_temp_path, compression, files = None, manifest = None):
+    extract_flags = "-xf" if compression[0] == "none" else "-xzf"
+    command = "mkdir -p {0} && tar -C {0} {1} -".format(remote_temp_path, extract_flags)
+    with traced("transfer", "stream {}".format(local_path), codec=compression[0]) as span:
+        channel = open_channel(c, command)
+        with channel.makefile('wb') as remote_stdin:
+            counted_stdin = CountingWriter(remote_stdin)
+            write_compressed_tool_archive(local_path, counted_stdin, compression, files=files, manifest=manifest)
+        channel.shutdown_write()
+        return_code = channel.recv_exit_status()
+        error = channel.makefile_stderr('rb').read().decode(errors='replace')
+        channel.close()
+        span["bytes"] = counted_stdin.bytes_written
+    if return_code != 0:
+        exit("Streaming {} to {} failed: {}".format(local_path, remote_temp_path, error))
+
+#Runs a command on the server, through sudo when a production user is given
+def run_as(c, command, user = None, **kwargs):
+    with traced("remote", command if len(command) < 200 else command[:200] + "...", user=user):
+        if not isinstance(c, Connection):
+            return c.run(command, **kwargs)
+        return get_session(c).run(command, user, **kwargs)
+
+#Without a host (e.g. a local target) fab2 hands tasks a plain invoke Context, which runs locally
+def run_local(c, command, **kwargs):
+    with traced("local", command):
+        if isinstance(c, Connection):
+            return c.local(command, **kwargs)
+        return c.run(command, **kwargs)
+
+def put_file(c, local_path, remote_path, **kwargs):
+    with traced("transfer", "put {}".format(remote_path), bytes=os.path.getsize(local_path)):
+        return get_session(c).put(local_path, remote_path, **kwargs)
+
+#Large files go up in checksummed chunks when transfer.resumable is set or striped over several streams, anything else in one sftp put
+def upload_file(c, local_path, remote_path):
+    settings = transfer_settings(c)
+    if (settings["resumable"] or int(settings["streams"]) > 1) and os.path.getsize(local_path) > int(settings["chunk_mb"]) << 20:
+        return put_resumable(c, local_path, remote_path)
+    return put_file(c, local_path, remote_path, preserve_mode=True)
+
+#Chunks are staged in a folder named by the file's checksum, a retry lists them with one sha256sum and only sends the missing or damaged ones
+def put_resumable(c, local_path, remote_path):
+    chunk_size = int(transfer_settings(c)["chunk_mb"]) << 20
+    journal_path, journal = read_upload_journal(local_path, chunk_size)
+    staging_path = "/tmp/ccms_upload_{}".format(journal["sha256"][:32])
+
+    result = run_as(c, "mkdir -p {0} && cd {0} && sha256sum chunk_* 2>/dev/null".format(staging_path), hide=True, warn=True)
+    on_server = {}
+    for line in result.stdout.splitlines():
+        checksum, _, name = line.strip().partition('  ')
+        on_server[name] = checksum
+    missing = [index for index, checksum in enumerate(journal["chunks"]) if on_server.get(chunk_name(index)) != checksum]
+    print("Uploading {} of {} chunks of {} ({} already on the server)".format(len(missing), len(journal["chunks"]), local_path, len(journal["chunks"]) - len(missing)))
+
+    #Chunks are striped over transfer.streams sftp channels, each channel has its own ssh window so together they can fill the link
+    session = get_session(c)
+    streams = max(1, min(int(transfer_settings(c)["streams"]), len(missing)))
+
+    def send_stripe(stream):
+        return sum(session.put_chunk(local_path, index * chunk_size, chunk_size, os.path.join(staging_path, chunk_name(index)), stream) for index in missing[stream::streams])
+
+    start = time.time()
+    with traced("transfer", "put {} chunks of {}".format(len(missing), remote_path), streams=streams) as span:
+        with ThreadPoolExecutor(max_workers=streams) as executor:
+            span["bytes"] = sum(executor.map(send_stripe, range(streams)))
+    if missing:
+        elapsed = max(time.time() - start, 1e-6)
+        print("Sent {:.1f} MB in {:.1f}s over {} streams ({:.1f} MB/s)".format(span["bytes"] / 1e6, elapsed, streams, span["bytes"] / elapsed / 1e6))
+
+    #The assembled file is checked against the whole file checksum before anything extracts it
+    result = run_as(c, "sh -c 'cat {0}/chunk_* > {1} && sha256sum {1}'".format(staging_path, remote_path), hide=True, warn=True)
+    if result.exited != 0 or result.stdout.split()[:1] != [journal["sha256"]]:
+        run_as(c, "rm -rf {} {}".format(staging_path, remote_path), warn=True)
+        exit("{} assembled on the server does not match {}, its chunks were discarded.".format(remote_path, local_path))
+    run_as(c, "rm -rf {}".format(staging_path))
+    os.remove(journal_path)
+
+#Local side of the journal, the file's chunk checksums are computed once and kept until the upload completes
+def read_upload_journal(local_path, chunk_size):
+    file_stat = os.stat(local_path)
+    key = hashlib.sha256("{}:{}:{}:{}".format(os.path.abspath(local_path), file_stat.st_size, file_stat.st_mtime, chunk_size).encode()).hexdigest()[:32]
+    journal_path = os.path.join(cache_dir, "uploads", "{}.json".format(key))
+    try:
+        with open(journal_path) as f:
+            return journal_path, json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    file_hash = hashlib.sha256()
+    chunks = []
+    with traced("local", "checksum {}".format(local_path)), open(local_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+            chunks.append(hashlib.sha256(chunk).hexdigest())
+    journal = {"file": os.path.abspath(local_path), "sha256": file_hash.hexdigest(), "chunk_size": chunk_size, "chunks": chunks}
+
+    os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+    with open(journal_path, 'w') as f:
+        json.dump(journal, f)
+    return journal_path, journal
+
+def chunk_name(index):
+    return "chunk_{:06d}".format(index)
+
+#Deployment plans, executed by deploy_agent.py in one invocation as the tool or workflow user
+
+#A local target deploys into local paths (e.g. for testing or benchmarking) through the same agent
+def is_local_target(c):
+    return c.get("target") == "local"
+
+def use_agent(c):
+    return is_local_target(c) or bool(c.get("agent", False))
+
+def workflow_plan(bundle_path, workflow_path, versioned_workflow_path, subcomponents, force_update, open_permissions = False):
+    plan = {
+        "directories": [versioned_workflow_path],
+        "archives": [{"source": bundle_path, "destination": versioned_workflow_path}],
+        "files": [],
+        "permissions": [],
+        "cleanup": [bundle_path]
+    }
+    if force_update:
+        plan["pointers"] = pointer_steps(workflow_path, os.path.basename(versioned_workflow_path), subcomponents)
+    if open_permissions:
+        plan["permissions"].append({"path": versioned_workflow_path, "mode": "777", "recursive": True})
+        for component in workflow_components:
+            plan["permissions"].append({"path": os.path.join(workflow_path, component), "mode": "777", "optional": True})
+    return plan
+
+#The default components are symlinks into versions/<version>, so switching versions is a rename per component
+def pointer_steps(workflow_path, workflow_version, components, optional = False):
+    return [{"source": os.path.join("versions", workflow_version, component), "destination": os.path.join(workflow_path, component), "optional": optional} for component in components]
+
+def pointer_commands(workflow_path, workflow_version, components, optional = False):
+    commands = []
+    for component in components:
+        source = os.path.join("versions", workflow_version, component)
+        destination = os.path.join(workflow_path, component)
+        command = "ln -sfn {} {}.ccms && mv -T {}.ccms {}".format(source, destination, destination, destination)
+        if optional:
+            command = "{{ test ! -e {} || {{ {}; }}; }}".format(os.path.join(workflow_path, source), command)
+        commands.append(command)
+    return commands
+
+def tool_plan(archive_path, final_path, open_permissions = False, link_from = None, deleted_files = []):
+    plan = {
+        "directories": [final_path],
+        "archives": [{"source": archive_path, "destination": final_path}],
+        "cleanup": [archive_path] + [os.path.join(final_path, relative_path) for relative_path in deleted_files]
+    }
+    if link_from:
+        plan["links"] = [{"source": link_from, "destination": final_path}]
+    if open_permissions:
+        plan["permissions"] = [{"path": final_path, "mode": "777", "recursive": True}]
+    return plan
+
+#Uploads a local payload for a plan (local targets get a hard link), the local file is left to the caller
+def stage_payload(c, local_path):
+    staged_name = "{}_{}".format(uuid.uuid4().hex[:8], os.path.basename(local_path))
+    if is_local_target(c):
+        staged_path = os.path.join(os.path.dirname(local_path), staged_name)
         try:
-            c.put(local_path, final_path, preserve_mode=True)
-        except:
-            c.put(local_path, final_path, preserve_mode=False)
-
-#TODO: update this to work with rsync
-def update_folder(c, local_path, final_path, production_user = None):
-    #Tar up local folder and upload to temporary space on server and untar
-    local_temp_path = os.path.join("/tmp/{}_{}.tar".format(local_path.replace("/", "_"), str(uuid.uuid4())))
-    cmd = "tar -C {} -chf {} .".format(local_path, local_temp_path)
-    # print(cmd)
-    os.system(cmd)
-
-    remote_temp_tar_path = os.path.join("/tmp/{}_{}.tar".format(local_path.replace("/", "_"), str(uuid.uuid4())))
-    c.put(local_temp_path, remote_temp_tar_path, preserve_mode=True)
-
-    remote_temp_path = os.path.join("/tmp/{}_{}".format(local_path.replace("/", "_"), str(uuid.uuid4())))
-    c.run("mkdir {}".format(remote_temp_path))
-    c.run("tar -C {} -xf {}".format(remote_temp_path, remote_temp_tar_path))
+            os.link(local_path, staged_path)
+        except OSError:
+            shutil.copy(local_path, staged_path)
+        return staged_path
+    remote_path = os.path.join("/tmp", staged_name)
+    upload_file(c, local_path, remote_path)
+    return remote_path
+
+def execute_plan(c, plan, user = None, payloads = []):
+    import deploy_agent
+
+    encoded_plan = deploy_agent.encode_plan(plan)
+    step_count = sum(len(plan.get(kind, [])) for kind in deploy_agent.plan_steps)
+    print("Executing deployment plan ({} steps){}".format(step_count, " as {}".format(user) if user else ""))
+
+    #A plan too large for one command line argument (e.g. thousands of deleted files) is staged as a file
+    plan_argument = encoded_plan
+    plan_path = None
+    if len(encoded_plan) > max_inline_plan:
+        local_plan_path = os.path.join("/tmp", "ccms_plan_{}.b64".format(uuid.uuid4().hex))
+        with open(local_plan_path, 'w') as f:
+            f.write(encoded_plan)
+        try:
+            plan_path = stage_payload(c, local_plan_path)
+        finally:
+            os.remove(local_plan_path)
+        plan_argument = "@" + plan_path
+
+    with traced("remote", "deploy agent", user=user, steps=step_count):
+        if is_local_target(c):
+            output = run_local(c, "{} {} {}".format(sys.executable, deploy_agent.__file__, plan_argument), hide=True, warn=True, echo=False).stdout
+        else:
+            with open(deploy_agent.__file__, 'rb') as f:
+                encoded_agent = base64.b64encode(f.read()).decode()
+            command = "sh -c 'echo {} | base64 -d | python3 - {}'".format(encoded_agent, plan_argument)
+            output = run_as(c, command, user, hide=True, warn=True, echo=False).stdout
+
+    #Payloads the agent user could not remove (e.g. uploaded to /tmp by the login user) are removed over sftp
+    if is_local_target(c):
+        if plan_path:
+            os.remove(plan_path)
+    else:
+        for payload in payloads + ([plan_path] if plan_path else []):
+            get_session(c).remove(payload)
+
+    result = deploy_agent.parse_result(output)
+    if result is None:
+        exit("Deploy agent did not return a result:\n{}".format(output))
+    for step in result["steps"]:
+        status = "skipped" if step.get("skipped") else ("ok" if step["ok"] else "FAILED: {}".format(step.get("error")))
+        print("\t{} {} {}".format(step["kind"], step["target"], status))
+    if not result["ok"]:
+        exit("Deployment plan failed: {}".format(result.get("error", "see failed steps above")))
+    return result
+
+#Raw exec channel on the connection's transport, for piping binary data
+def open_channel(c, command, echo = None):
+    if echo is None:
+        echo = c.config.run.echo
+    if echo:
+        print("\033[1;37m{}\033[0m".format(command))
+    channel = get_session(c).connection.create_session()
+    channel.exec_command(command)
+    return channel
+
+#One session per user@host:port for the whole process, the first connection's transport and sftp client are reused by every task
+#The handshake runs under a lock per host only, so several hosts connect at the same time
+def get_session(c):
+    key = (c.user, c.host, c.port)
+    with sessions_lock:
+        if key in sessions:
+            return sessions[key]
+        open_lock = session_open_locks.setdefault(key, threading.Lock())
+    with open_lock:
+        with sessions_lock:
+            if key in sessions:
+                return sessions[key]
+        c.open()
+        session = Session(c)
+        with sessions_lock:
+            sessions[key] = session
+        return session
+
+@atexit.register
+def close_sessions():
+    with sessions_lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+
+class Session:
+    def __init__(self, connection):
+        self.connection = connection
+        self.sftp_lock = threading.Lock()
+        self.sftp_streams = {}
+        self.sftp_streams_lock = threading.Lock()
+        #Idle shells and the number started per user, up to one per concurrent deployment so sudo commands are not serialized
+        self.idle_shells = {}
+        self.started_shells = {}
+        self.sudo_per_command = set()
+        self.shells_lock = threading.Condition()
+        self.persistent_shell = connection.config.get("persistent_shell", True)
+        self.shells_per_user = max(1, int(connection.config.get("concurrency", 1)))
+
+    def run(self, command, user = None, **kwargs):
+        if user and self.persistent_shell:
+            shell = self.acquire_shell(user)
+            if shell:
+                try:
+                    return shell.run(command, **kwargs)
+                finally:
+                    self.release_shell(user, shell)
+        if user:
+            return self.connection.sudo(command, user=user, pty=True, **kwargs)
+        return self.connection.run(command, **kwargs)
+
+    def put(self, local_path, remote_path, **kwargs):
+        with self.sftp_lock:
+            return self.connection.put(local_path, remote_path, **kwargs)
+
+    #Missing parent folders are created, new tool files can be in new folders
+    def put_replace(self, local_path, remote_path, mode):
+        with self.sftp_lock:
+            sftp = self.connection.sftp()
+            try:
+                sftp.put(local_path, remote_path + ".ccms")
+            except IOError:
+                self.connection.run("mkdir -p {}".format(shlex.quote(os.path.dirname(remote_path))), hide=True)
+                sftp.put(local_path, remote_path + ".ccms")
+            sftp.chmod(remote_path + ".ccms", mode)
+            sftp.posix_rename(remote_path + ".ccms", remote_path)
+
+    #Written under a temporary name and renamed, so a chunk on the server is either complete or absent
+    def put_chunk(self, local_path, offset, size, remote_path, stream = 0):
+        with open(local_path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size)
+        sftp, lock = self.sftp_stream(stream)
+        with lock:
+            sftp.putfo(io.BytesIO(data), remote_path + ".part")
+            sftp.posix_rename(remote_path + ".part", remote_path)
+        return len(data)
+
+    #Stream 0 is the connection's own sftp client, the others are extra sftp channels on the same transport
+    def sftp_stream(self, stream):
+        if stream == 0:
+            return self.connection.sftp(), self.sftp_lock
+        with self.sftp_streams_lock:
+            if stream not in self.sftp_streams:
+                self.sftp_streams[stream] = (paramiko.SFTPClient.from_transport(self.connection.transport), threading.Lock())
+            return self.sftp_streams[stream]
+
+    def remove(self, remote_path):
+        with self.sftp_lock:
+            try:
+                self.connection.sftp().remove(remote_path)
+            except IOError:
+                pass
 
-    if production_user:
-        c.sudo('rsync -rlptD {}/ {}'.format(remote_temp_path, final_path), user=production_user, pty=True)
+    #Waits for an idle shell or starts another one, falls back to per-command sudo if the first cannot be started for this user
+    def acquire_shell(self, user):
+        with self.shells_lock:
+            while True:
+                if user in self.sudo_per_command:
+                    return None
+                idle = self.idle_shells.setdefault(user, [])
+                if idle:
+                    return idle.pop()
+                if self.started_shells.get(user, 0) < self.shells_per_user:
+                    self.started_shells[user] = self.started_shells.get(user, 0) + 1
+                    break
+                self.shells_lock.wait()
+        try:
+            return PrivilegedShell(self.connection, user)
+        except Exception as e:
+            with self.shells_lock:
+                self.started_shells[user] -= 1
+                if not self.started_shells[user]:
+                    print("Could not start a persistent shell for {}, using sudo per command: {}".format(user, e))
+                    self.sudo_per_command.add(user)
+                self.shells_lock.notify_all()
+            return None
+
+    #Shells closed by a failure or timeout are dropped and replaced on demand
+    def release_shell(self, user, shell):
+        with self.shells_lock:
+            if shell.closed:
+                self.started_shells[user] -= 1
+            else:
+                self.idle_shells[user].append(shell)
+            self.shells_lock.notify_all()
+
+    def close(self):
+        with self.shells_lock:
+            for shells in self.idle_shells.values():
+                for shell in shells:
+                    shell.close()
+            self.idle_shells = {}
+            self.started_shells = {}
+        for sftp, lock in self.sftp_streams.values():
+            sftp.close()
+        self.sftp_streams = {}
+
+#A single sudo'd shell kept open for a user, commands are written to its stdin and delimited by a marker with the exit code
+class PrivilegedShell:
+    def __init__(self, connection, user, timeout = 30, command_timeout = 3600):
+        self.connection = connection
+        self.user = user
+        self.lock = threading.Lock()
+        self.closed = False
+        #A hung command (or one with unbalanced quotes) would otherwise block its caller forever
+        self.command_timeout = connection.config.timeouts.command or command_timeout
+        self.prompt = "ccms_sudo_prompt_{}:".format(uuid.uuid4().hex)
+        ready_marker = "ccms_shell_ready_{}".format(uuid.uuid4().hex)
+
+        self.channel = connection.create_session()
+        self.channel.set_combine_stderr(True)
+        self.channel.settimeout(1)
+        self.channel.exec_command("sudo -S -p '{}' -H -u {} sh -c 'echo {}; exec sh'".format(self.prompt, user, ready_marker))
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.buffer = ""
+        password_sent = False
+        deadline = time.time() + timeout
+        while ready_marker not in self.buffer:
+            if self.prompt in self.buffer:
+                password = connection.config.sudo.password
+                if password_sent:
+                    raise Exception("sudo password was rejected")
+                if password is None:
+                    raise Exception("no sudo password available, use --prompt-for-sudo-password")
+                self.channel.sendall("{}\n".format(password).encode())
+                self.buffer = self.buffer.replace(self.prompt, "")
+                password_sent = True
+            if time.time() > deadline:
+                self.channel.close()
+                raise Exception(self.buffer.strip() or "shell did not start")
+            self.receive()
+        self.buffer = self.buffer[self.buffer.index(ready_marker) + len(ready_marker):].lstrip("\r\n")
+
+    def receive(self):
+        try:
+            data = self.channel.recv(1 << 16)
+        except socket.timeout:
+            return
+        if not data:
+            raise Exception("Persistent shell for {} closed: {}".format(self.user, self.buffer.strip()))
+        self.buffer += self.decoder.decode(data)
+
+    def run(self, command, hide = False, warn = None, echo = None, **kwargs):
+        if warn is None:
+            warn = self.connection.config.run.warn
+        if echo is None:
+            echo = self.connection.config.run.echo
+        if echo:
+            print("\033[1;37msudo -u {} {}\033[0m".format(self.user, command))
+
+        done_marker = "ccms_command_done_{}".format(uuid.uuid4().hex)
+        with self.lock:
+            #The leading newline makes sure the marker starts its own line, $? is still the command's status
+            self.channel.sendall("( {} ) < /dev/null 2>&1; printf '\\n{} %s\\n' $?\n".format(command, done_marker).encode())
+            deadline = time.time() + self.command_timeout
+            try:
+                while done_marker not in self.buffer or "\n" not in self.buffer[self.buffer.index(done_marker):]:
+                    if time.time() > deadline:
+                        raise CommandTimedOut(Result(stdout=self.buffer, command=command, exited=-1), self.command_timeout)
+                    self.receive()
+            except BaseException:
+                #The shell is in an unknown state, it is closed and the session starts a new one for the next command
+                self.close()
+                raise
+            output, remainder = self.buffer.split(done_marker, 1)
+            exit_line, self.buffer = remainder.split("\n", 1)
+
+        output = output[:-1] if output.endswith("\n") else output
+        if not hide:
+            print(output, end="")
+        result = Result(stdout=output, command=command, exited=int(exit_line.strip()), hide=("stdout",) if hide else ())
+        if result.exited != 0 and not warn:
+            raise UnexpectedExit(result)
+        return result
+
+    def close(self):
+        self.closed = True
+        try:
+            self.channel.sendall(b"exit\n")
+        except Exception:
+            pass
+        self.channel.close()
+
+class CountingWriter:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+def transfer_settings(c):
+    settings = {"method": "put", "incremental": False, "compression": "none", "compression_level": 6, "link_previous": False, "resumable": False, "chunk_mb": 64, "streams": 1}
+    if "transfer" in c:
+        settings.update(c["transfer"])
+    return settings
+
+#Writes the tool folder as a tar (dereferencing links like tar -h), limited to files if given
+def write_tool_archive(local_path, fileobj, files = None, manifest = None, mode = 'w'):
+    import tarfile
+    with tarfile.open(fileobj=fileobj, mode=mode, dereference=True) as tar:
+        if files is None:
+            tar.add(local_path, arcname='.')
+        else:
+            for relative_path in files:
+                tar.add(os.path.join(local_path, relative_path), arcname=relative_path, recursive=False)
+        if manifest is not None:
+            manifest_bytes = json.dumps(manifest, indent=1, sort_keys=True).encode()
+            manifest_info = tarfile.TarInfo(tool_manifest_name)
+            manifest_info.size = len(manifest_bytes)
+            manifest_info.mtime = int(time.time())
+            manifest_info.mode = 0o644
+            tar.addfile(manifest_info, io.BytesIO(manifest_bytes))
+
+def write_compressed_tool_archive(local_path, fileobj, compression, files = None, manifest = None):
+    import gzip
+    codec, level = compression
+    if codec == "none":
+        write_tool_archive(local_path, fileobj, files=files, manifest=manifest, mode='w|')
+        return
+    if codec == "parallel":
+        compressed = ParallelGzipWriter(fileobj, level)
     else:
-        c.run('rsync -rlptD {}/ {}'.format(remote_temp_path, final_path))
+        compressed = gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=level, mtime=0)
+    write_tool_archive(local_path, compressed, files=files, manifest=manifest, mode='w|')
+    compressed.close()
+
+def compress_block(data, level):
+    import gzip
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+#Gzip writer that compresses fixed size blocks on a process pool, each block is its own gzip member
+class ParallelGzipWriter:
+    def __init__(self, fileobj, level, block_size = 4 << 20, processes = None):
+        from concurrent.futures import ProcessPoolExecutor
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.processes = processes or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=self.processes)
+        self.buffer = bytearray()
+        self.pending = []
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def submit(self, block):
+        self.pending.append(self.executor.submit(compress_block, block, self.level))
+        #Blocks are written in order and at most two per process are kept in flight
+        while len(self.pending) > 2 * self.processes:
+            self.fileobj.write(self.pending.pop(0).result())
+
+    def close(self):
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        for future in self.pending:
+            self.fileobj.write(future.result())
+        self.pending = []
+        self.executor.shutdown()
+
+#Picks the codec and level, auto compares sampled compression speed and ratio against the link throughput
+def choose_compression(c, local_path, files = None):
+    import zlib
+    settings = transfer_settings(c)
+    codec = settings["compression"]
+    level = int(settings["compression_level"])
+    if codec != "auto":
+        return (codec, level)
+    #A local target has no link to save time on
+    if is_local_target(c):
+        return ("none", level)
+
+    sample = sample_tree(local_path, files)
+    if not sample:
+        return ("none", level)
+
+    if "link_mbps" in settings:
+        link_throughput = float(settings["link_mbps"]) * 1e6 / 8
+    else:
+        link_throughput = measure_link_throughput(c, sample)
+
+    processes = os.cpu_count() or 1
+    candidates = [("none", level, 1.0, float('inf'))]
+    for candidate_level in (1, 6, 9):
+        start = time.time()
+        ratio = len(zlib.compress(sample, candidate_level)) / len(sample)
+        compress_throughput = len(sample) / max(time.time() - start, 1e-6)
+        candidates.append(("gzip", candidate_level, ratio, compress_throughput))
+        if processes > 1:
+            candidates.append(("parallel", candidate_level, ratio, compress_throughput * processes))
+
+    #Compression and transfer are pipelined so the slower of the two bounds each byte
+    codec, level, ratio, compress_throughput = min(candidates, key=lambda candidate: max(1 / candidate[3], candidate[2] / link_throughput))
+    print("Link {:.1f} MB/s, using {} compression (level {}, ratio {:.2f})".format(link_throughput / 1e6, codec, level, ratio))
+    return (codec, level)
+
+def sample_tree(local_path, files = None, sample_size = 4 << 20, per_file = 256 << 10):
+    if files is None:
+        files = []
+        for root, dirs, filenames in os.walk(local_path, followlinks=True):
+            dirs.sort()
+            files.extend(os.path.relpath(os.path.join(root, filename), local_path) for filename in sorted(filenames))
+    sample = bytearray()
+    for relative_path in files:
+        path = os.path.join(local_path, relative_path)
+        if not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            sample.extend(f.read(min(per_file, sample_size - len(sample))))
+        if len(sample) >= sample_size:
+            break
+    return bytes(sample)
+
+def measure_link_throughput(c, sample):
+    with traced("transfer", "measure link throughput", bytes=len(sample)):
+        channel = open_channel(c, "cat > /dev/null", echo=False)
+        start = time.time()
+        channel.sendall(sample)
+        channel.shutdown_write()
+        channel.recv_exit_status()
+        elapsed = max(time.time() - start, 1e-6)
+        channel.close()
+    return len(sample) / elapsed
+
+#Maps every file and directory under local_path to the sha256 of its content
+def hash_tree(local_path):
+    manifest = {}
+    for root, dirs, files in os.walk(local_path, followlinks=True):
+        dirs.sort()
+        for dirname in dirs:
+            manifest[os.path.relpath(os.path.join(root, dirname), local_path)] = "directory"
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            relative_path = os.path.relpath(path, local_path)
+            if relative_path == tool_manifest_name or not os.path.isfile(path):
+                continue
+            manifest[relative_path] = file_sha256(path)
+    return manifest
+
+def file_sha256(path):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def read_remote_manifest(c, final_path):
+    result = run_as(c, "cat {} 2>/dev/null".format(os.path.join(final_path, tool_manifest_name)), hide=True, warn=True)
+    try:
+        return json.loads(result.stdout)
+    except ValueError:
+        return {}
+
+def changed_files(manifest, remote_manifest):
+    return [relative_path for relative_path, file_hash in sorted(manifest.items()) if remote_manifest.get(relative_path) != file_hash]
 
-    if os.path.split(os.path.normpath(remote_temp_path))[0] == '/tmp':
-        c.run('rm -rf {}'.format(remote_temp_path))
-    if os.path.split(os.path.normpath(remote_temp_tar_path))[0] == '/tmp':
-        c.run('rm {}'.format(remote_temp_tar_path))
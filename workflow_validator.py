@@ -5,8 +5,76 @@ import getopt
 import os
 import xml.etree.ElementTree as ET
 import logging
-
-logging.basicConfig(filename='validation.log',format = "%(levelname) -10s %(module)s:%(lineno)s %(message)s", level = logging.DEBUG)
+import hashlib
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger("workflow_validator")
+
+workflow_files = ["flow.xml", "binding.xml", "tool.xml"]
+default_cache_filename = os.path.join(os.path.expanduser("~"), ".cache", "ccmsdeployments", "validation_cache.json")
+
+#Tracing of every lookup is opt-in, it goes to the terminal and validation.log
+def enable_tracing(log_filename = "validation.log"):
+	formatter = logging.Formatter("%(levelname) -10s %(module)s:%(lineno)s %(message)s")
+	for handler in [logging.StreamHandler(), logging.FileHandler(log_filename)]:
+		handler.setFormatter(formatter)
+		logger.addHandler(handler)
+	logger.setLevel(logging.DEBUG)
+
+#Accepts either a filename or an already parsed root element
+def getroot(xml):
+	if isinstance(xml, ET.Element):
+		return xml
+	return ET.parse(xml).getroot()
+
+#Iterative Tarjan, adjacency is a list of successor lists indexed by node, runs in O(V+E)
+def stronglyconnected(adjacency):
+	index = [-1] * len(adjacency)
+	lowlink = [0] * len(adjacency)
+	on_stack = [False] * len(adjacency)
+	stack = []
+	components = []
+	counter = 0
+	for root in range(len(adjacency)):
+		if index[root] != -1:
+			continue
+		index[root] = lowlink[root] = counter
+		counter += 1
+		stack.append(root)
+		on_stack[root] = True
+		work = [(root, iter(adjacency[root]))]
+		while work:
+			node, children = work[-1]
+			advanced = False
+			for child in children:
+				if index[child] == -1:
+					index[child] = lowlink[child] = counter
+					counter += 1
+					stack.append(child)
+					on_stack[child] = True
+					work.append((child, iter(adjacency[child])))
+					advanced = True
+					break
+				elif on_stack[child]:
+					lowlink[node] = min(lowlink[node], index[child])
+			if advanced:
+				continue
+			work.pop()
+			if work:
+				parent = work[-1][0]
+				lowlink[parent] = min(lowlink[parent], lowlink[node])
+			if lowlink[node] == index[node]:
+				component = []
+				while True:
+					member = stack.pop()
+					on_stack[member] = False
+					component.append(member)
+					if member == node:
+						break
+				components.append(component)
+	return components
 
 class FlowItem:
 	def __init__(self, stagename, input_entries, output_entries):
@@ -15,6 +83,8 @@ class FlowItem:
 		#the dataflow, whereas the port is used in binding to the tool
 		self.input_entries = input_entries
 		self.output_entries = output_entries
+		self.input_ports = set(entry.get("port") for entry in input_entries)
+		self.output_ports = set(entry.get("port") for entry in output_entries)
 
 	def validate(self):
 		#Checking if output names and input names do not occur more than once
@@ -25,25 +95,15 @@ class FlowItem:
 	def validateDeclare(self, declareMap):
 		unDeclared=[];
 		for input in self.input_entries:
-			if("object" in input):
-				object = input["object"];
-			if("collection" in input):
-				object = input["collection"];
-			if not (object in declareMap):
+			object = input.get("object", input.get("collection"))
+			if object is not None and not (object in declareMap):
 				unDeclared.append(object);
 		return unDeclared;
 
 	def portpresent(self, isInput, portname):
 		if isInput:
-			for input_entry in self.input_entries:
-				if input_entry["port"] == portname:
-					return True
-			return False
-		else:
-			for output_entry in self.output_entries:
-				if output_entry["port"] == portname:
-					return True
-			return False
+			return portname in self.input_ports
+		return portname in self.output_ports
 
 class ToolItem:
 	def __init__(self, toolname, toolpath, input_entries, output_entries):
@@ -51,23 +111,17 @@ class ToolItem:
 		self.input_entries = input_entries
 		self.output_entries = output_entries
 		self.toolpath = toolpath
+		self.input_names = set(entry.get("name") for entry in input_entries)
+		self.output_names = set(entry.get("name") for entry in output_entries)
 
 	def validate(self):
 		#TODO
 		return True;
 
 	def parameterpresent(self, isInput, parametername):
-
 		if isInput:
-			for input_entry in self.input_entries:
-				if input_entry["name"] == parametername:
-					return True
-			return False
-		else:
-			for output_entry in self.output_entries:
-				if output_entry["name"] == parametername:
-					return True
-			return False
+			return parametername in self.input_names
+		return parametername in self.output_names
 
 
 class BindingItem:
@@ -82,26 +136,56 @@ class BindingItem:
 		return True;
 
 class Workflow:
-	def __init__(self, flow_xml_filename, binding_xml_name, tool_xml_name):
+	def __init__(self, flow_xml_filename, binding_xml_name, tool_xml_name, verbose = False):
+		if verbose and not logger.handlers:
+			enable_tracing()
 		self.error_list = []
+		self.report = []
 		self.exemptflownames = ["begin", "end"]
-		self.declarations = self.createFlowDeclareMap(flow_xml_filename)
-		print("Parsing flow.xml")
-		self.flows_list = self.parseflow(flow_xml_filename)
-		print("Parsing tool.xml")
-		self.tools_list = self.parsetool(tool_xml_name)
-		print("Parsing binding.xml")
-		self.binding_list = self.parseBinding(binding_xml_name)
 
+		#Each file is parsed exactly once
+		logger.info("Parsing flow.xml")
+		flow_root = getroot(flow_xml_filename)
+		self.declarations = self.createFlowDeclareMap(flow_root)
+		self.flows_list = self.parseflow(flow_root)
+		logger.info("Parsing tool.xml")
+		self.tools_list = self.parsetool(getroot(tool_xml_name))
+		logger.info("Parsing binding.xml")
+		self.binding_list = self.parseBinding(getroot(binding_xml_name))
 
 		self.createaccessmaps()
 
+	#Every problem is kept both as a structured entry and as the legacy message string
+	def adderror(self, category, item, message):
+		self.report.append({"severity": "error", "category": category, "item": item, "message": message})
+		self.error_list.append(message)
+
+	def addwarning(self, category, item, message):
+		self.report.append({"severity": "warning", "category": category, "item": item, "message": message})
+
+	def results(self):
+		errors = [entry for entry in self.report if entry["severity"] == "error"]
+		warnings = [entry for entry in self.report if entry["severity"] == "warning"]
+		return {
+			"valid": len(errors) == 0,
+			"errors": errors,
+			"warnings": warnings,
+			"counts": {"actions": len(self.flows_list), "tools": len(self.tools_list), "bindings": len(self.binding_list)}
+		}
+
 	def printerrors(self):
 		print("======================Workflow XML Error List==============================")
-		logging.debug("======================Workflow XML Error List==============================")
+		logger.debug("======================Workflow XML Error List==============================")
 		for error_item in self.error_list:
 			print(error_item)
-			logging.debug(error_item)
+			logger.debug(error_item)
+		warnings = self.results()["warnings"]
+		if warnings:
+			print("======================Workflow XML Warning List============================")
+			logger.debug("======================Workflow XML Warning List============================")
+			for warning in warnings:
+				print("{}: {}".format(warning["category"], warning["message"]))
+				logger.debug(warning["message"])
 
 	#Creating easy lookups for binding objects
 	def createaccessmaps(self):
@@ -129,21 +213,21 @@ class Workflow:
 
 
 	#create lookup map for flow objects and collections declaration
-	def createFlowDeclareMap(self, flow_xml_filename):
+	def createFlowDeclareMap(self, flow_xml):
 		declarations = set()
-		tree = ET.parse(flow_xml_filename)
-		root = tree.getroot()
+		self.declared_collections = set()
+		root = getroot(flow_xml)
 		for child in root:
 			if child.tag=="object" or child.tag=="collection":
 				declarations.add(child.attrib["name"])
+			if child.tag=="collection":
+				self.declared_collections.add(child.attrib["name"])
 		return declarations
 
 	#Parsing the Flow.xml
-	def parseflow(self, flow_xml_filename):
+	def parseflow(self, flow_xml):
 		flows_list = []
-		#print declaration;
-		tree = ET.parse(flow_xml_filename)
-		root = tree.getroot()
+		root = getroot(flow_xml)
 		for child in root:
 			#Looking for only actions
 			if(child.tag == "action"):
@@ -167,11 +251,10 @@ class Workflow:
 		return flows_list
 
 	#Parsing the Tool.xml
-	def parsetool(self, tool_xml_name):
+	def parsetool(self, tool_xml):
 		tools_list = []
 
-		tree = ET.parse(tool_xml_name)
-		root = tree.getroot()
+		root = getroot(tool_xml)
 
 		#First Getting All Tool Paths
 		tool_path_present = {}
@@ -181,7 +264,7 @@ class Workflow:
 					if toolPathItem.tag == "toolPath":
 						toolname = toolPathItem.attrib["tool"]
 						if toolname in tool_path_present:
-							self.error_list.append("Tool Path Redefinition in Tool.xml: " + toolname)
+							self.adderror("toolpath", toolname, "Tool Path Redefinition in Tool.xml: " + toolname)
 						else:
 							tool_path_present[toolname] = child.attrib["base"] + "/" + toolPathItem.attrib["path"]
 
@@ -204,7 +287,7 @@ class Workflow:
 				if toolname in tool_path_present:
 					toolpath = tool_path_present[toolname]
 				else:
-					self.error_list.append("Missing path for tool: " + toolname)
+					self.adderror("toolpath", toolname, "Missing path for tool: " + toolname)
 
 				tool = ToolItem(toolname, toolpath, tool_input, tool_output)
 
@@ -213,11 +296,10 @@ class Workflow:
 		return tools_list
 
 	#Parsing the binding xml file
-	def parseBinding(self, binding_xml_name):
+	def parseBinding(self, binding_xml):
 		binding_list = []
 
-		tree = ET.parse(binding_xml_name)
-		root = tree.getroot()
+		root = getroot(binding_xml)
 
 		for child in root :
 			if child.tag == "bind":
@@ -255,7 +337,7 @@ class Workflow:
 			binding_port_value = binding_input["port"]
 			#Check if this is present
 			if flow_item.portpresent(True, binding_port_value):
-				print("PORT FOUND IN INPUT FLOW "  + flow_item.stagename)
+				logger.debug("PORT FOUND IN INPUT FLOW %s", flow_item.stagename)
 			else:
 				output_errors.append("Port in binding not found in flow: " + flow_item.stagename)
 
@@ -264,7 +346,7 @@ class Workflow:
 			binding_port_value = binding_output["port"]
 			#Check if this is present
 			if flow_item.portpresent(False, binding_port_value):
-				print("PORT FOUND IN OUTPUT FLOW " + flow_item.stagename)
+				logger.debug("PORT FOUND IN OUTPUT FLOW %s", flow_item.stagename)
 			else:
 				output_errors.append("Port in binding not found in flow: " + flow_item.stagename)
 		return output_errors
@@ -282,7 +364,7 @@ class Workflow:
 			binding_requirement_name = binding_input["requirement"]
 			#Check if this is present
 			if tool_item.parameterpresent(True, binding_requirement_name):
-				print("INPUT FOUND IN INPUT Tool "  + tool_item.toolname + " " + binding_requirement_name)
+				logger.debug("INPUT FOUND IN INPUT Tool %s %s", tool_item.toolname, binding_requirement_name)
 			else:
 				output_errors.append("Tool parameter in binding: " + binding_requirement_name + " not found in tool: " + tool_item.toolname)
 
@@ -298,18 +380,17 @@ class Workflow:
 		for flow_item in self.flows_list:
 			unDeclared = flow_item.validateDeclare(self.declarations);
 			if len(unDeclared) > 0:
-				self.error_list.append("Flow [" + flow_item.stagename + "] contains undeclared items: " + str(unDeclared))
+				self.adderror("undeclared", flow_item.stagename, "Flow [" + flow_item.stagename + "] contains undeclared items: " + str(unDeclared))
 			if flow_item.validate() == False:
-				self.error_list.append("Flow Validation Error: " + flow_item.stagename)
+				self.adderror("flow", flow_item.stagename, "Flow Validation Error: " + flow_item.stagename)
 
 		#Validating Tool
 		for tool_item in self.tools_list:
 			if(tool_item.validate() == False):
-				self.error_list.append("Tool Validation Error: " + tool_item.toolname)
-
-		#Validating no cycles in data flow
-		#We'll punt on this for a while, we'll only check that it doesn't go from input to output on the same node
+				self.adderror("tool", tool_item.toolname, "Tool Validation Error: " + tool_item.toolname)
 
+		#Validating no cycles, unreachable actions and unused outputs in the data flow
+		self.analyzedataflow()
 
 		#Validating the connection from tool to flow through binding
 		for flow in self.flows_list:
@@ -320,30 +401,217 @@ class Workflow:
 
 			if flowname in self.binding_flow_map:
 				binding_item = self.binding_flow_map[flowname]
-				self.error_list.extend(Workflow.validate_flow_to_binding(flow, binding_item))
+				for error in Workflow.validate_flow_to_binding(flow, binding_item):
+					self.adderror("port", flowname, error)
 
 				#Validate Binding to Tool
 				tool_name = binding_item.toolname
 
 				if tool_name in self.tool_map:
-					self.error_list.extend(Workflow.validate_binding_to_tool(binding_item, self.tool_map[tool_name]))
+					for error in Workflow.validate_binding_to_tool(binding_item, self.tool_map[tool_name]):
+						self.adderror("parameter", tool_name, error)
 				else:
-					self.error_list.append("Tool not found for flow: " + flowname + " should be named: " + tool_name)
+					self.adderror("binding", flowname, "Tool not found for flow: " + flowname + " should be named: " + tool_name)
 
 			else:
-				self.error_list.append("Binding not found for flow: " + flowname)
+				self.adderror("binding", flowname, "Binding not found for flow: " + flowname)
 
+		return len(self.error_list) == 0
+
+
+	#Actions and objects/collections form one graph: data -> action for inputs and action -> data for outputs
+	def builddataflowgraph(self):
+		node_ids = {}
+		node_names = []
+		adjacency = []
+
+		def node(kind, name):
+			key = (kind, name)
+			if key not in node_ids:
+				node_ids[key] = len(node_names)
+				node_names.append(key)
+				adjacency.append([])
+			return node_ids[key]
+
+		for flow_item in self.flows_list:
+			action = node("action", flow_item.stagename)
+			for entry in flow_item.input_entries:
+				data_name = entry.get("object", entry.get("collection"))
+				if data_name is not None:
+					adjacency[node("data", data_name)].append(action)
+			for entry in flow_item.output_entries:
+				data_name = entry.get("object", entry.get("collection"))
+				if data_name is not None:
+					adjacency[action].append(node("data", data_name))
+
+		return node_ids, node_names, adjacency
+
+	def analyzedataflow(self):
+		node_ids, node_names, adjacency = self.builddataflowgraph()
+
+		#Cycles are strongly connected components with more than one node or a self loop
+		for component in stronglyconnected(adjacency):
+			if len(component) == 1 and component[0] not in adjacency[component[0]]:
+				continue
+			actions = sorted(node_names[member][1] for member in component if node_names[member][0] == "action")
+			self.adderror("cycle", ",".join(actions), "Cycle in data flow between actions: " + str(actions))
+
+		#Reachability from begin
+		begin = node_ids.get(("action", "begin"))
+		if begin is not None:
+			reached = [False] * len(node_names)
+			reached[begin] = True
+			frontier = [begin]
+			while frontier:
+				current = frontier.pop()
+				for successor in adjacency[current]:
+					if not reached[successor]:
+						reached[successor] = True
+						frontier.append(successor)
+			for flow_item in self.flows_list:
+				if not reached[node_ids[("action", flow_item.stagename)]]:
+					self.addwarning("unreachable", flow_item.stagename, "Action not reachable from begin: " + flow_item.stagename)
+
+		#Collections that no action reads
+		for collection in sorted(self.declared_collections):
+			collection_node = node_ids.get(("data", collection))
+			if collection_node is None or len(adjacency[collection_node]) == 0:
+				self.addwarning("unconsumed", collection, "Collection never consumed: " + collection)
+
+		#Checking from tool to binding, every produce should be bound to an output port
+		bound_productions = {}
+		for binding_item in self.binding_list:
+			productions = bound_productions.setdefault(binding_item.toolname, set())
+			for binding_output in binding_item.output_entries:
+				productions.add(binding_output.get("production"))
+		for tool_item in self.tools_list:
+			if tool_item.toolname not in bound_productions:
+				continue
+			for output_entry in tool_item.output_entries:
+				if output_entry.get("name") not in bound_productions[tool_item.toolname]:
+					self.addwarning("unbound", tool_item.toolname, "Tool output never bound: " + output_entry.get("name") + " in tool: " + tool_item.toolname)
+
+
+#Validates one folder containing flow.xml, binding.xml and tool.xml, returning the structured results
+def validatefolder(folder):
+	try:
+		workflow = Workflow(os.path.join(folder, "flow.xml"), os.path.join(folder, "binding.xml"), os.path.join(folder, "tool.xml"))
+		workflow.validate()
+		return workflow.results()
+	except Exception as e:
+		error = {"severity": "error", "category": "parse", "item": folder, "message": "Could not validate {}: {}".format(folder, e)}
+		return {"valid": False, "errors": [error], "warnings": [], "counts": {}}
+
+#Cache key covering the workflow files and the validator itself
+def contenthash(folder):
+	content_hash = hashlib.sha256()
+	with open(os.path.abspath(__file__), "rb") as f:
+		content_hash.update(f.read())
+	for filename in workflow_files:
+		content_hash.update(filename.encode())
+		with open(os.path.join(folder, filename), "rb") as f:
+			content_hash.update(f.read())
+	return content_hash.hexdigest()
+
+#Every folder under base_dir holding all workflow files, tool trees and hidden folders are not descended
+def findworkflowfolders(base_dir = "."):
+	folders = []
+	for root, dirs, files in os.walk(base_dir):
+		dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d != "tools")
+		if all(filename in files for filename in workflow_files):
+			folders.append(root)
+	return folders
+
+#Validates all folders on a process pool, skipping folders whose content hash is already in the on-disk cache
+#The cache keeps the hashes of this run first, then the most recent others up to cache_limit entries
+def validaterepository(folders, cache_filename = default_cache_filename, processes = None, cache_limit = 1000):
+	cache = {}
+	if cache_filename and os.path.isfile(cache_filename):
+		try:
+			with open(cache_filename) as f:
+				cache = json.load(f)
+		except ValueError:
+			cache = {}
+
+	results = {}
+	to_validate = {}
+	current_hashes = {}
+	for folder in folders:
+		try:
+			folder_hash = contenthash(folder)
+		except OSError:
+			results[folder] = validatefolder(folder)
+			continue
+		current_hashes[folder] = folder_hash
+		if folder_hash in cache:
+			results[folder] = cache[folder_hash]
+		else:
+			to_validate[folder] = folder_hash
+
+	if len(to_validate) > 1:
+		with ProcessPoolExecutor(max_workers=processes) as executor:
+			for folder, result in zip(to_validate, executor.map(validatefolder, to_validate)):
+				results[folder] = result
+	else:
+		for folder in to_validate:
+			results[folder] = validatefolder(folder)
+
+	if cache_filename:
+		pruned_cache = {}
+		for folder, folder_hash in current_hashes.items():
+			pruned_cache[folder_hash] = results[folder]
+		for folder_hash, result in cache.items():
+			if len(pruned_cache) >= max(cache_limit, len(current_hashes)):
+				break
+			pruned_cache.setdefault(folder_hash, result)
+		if not to_validate and list(pruned_cache) == list(cache):
+			return results, 0
+		cache = pruned_cache
+		os.makedirs(os.path.dirname(os.path.abspath(cache_filename)), exist_ok=True)
+		temp_cache_filename = "{}.{}".format(cache_filename, os.getpid())
+		with open(temp_cache_filename, "w") as f:
+			json.dump(cache, f)
+		os.replace(temp_cache_filename, cache_filename)
+
+	return results, len(to_validate)
+
+def printrepositoryresults(results):
+	for folder in sorted(results):
+		result = results[folder]
+		print("{}: {} ({} errors, {} warnings)".format(folder, "OK" if result["valid"] else "INVALID", len(result["errors"]), len(result["warnings"])))
+		for entry in result["errors"] + result["warnings"]:
+			print("\t{}: {}".format(entry["severity"], entry["message"]))
+	return all(result["valid"] for result in results.values())
 
 def usage():
-	print("<workflow folder>")
+	print("[-v|--verbose] <workflow folder>")
+	print("-a|--all [base folder]")
 
 
 
 
 def main():
-	usage()
-	folder = sys.argv[1]
-	workflow = Workflow(folder + "/flow.xml", folder + "/binding.xml",folder + "/tool.xml")
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], "va", ["verbose", "all"])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	verbose = any(opt in ("-v", "--verbose") for opt, value in opts)
+
+	if any(opt in ("-a", "--all") for opt, value in opts):
+		start = time.time()
+		folders = findworkflowfolders(args[0] if args else ".")
+		results, validated = validaterepository(folders)
+		valid = printrepositoryresults(results)
+		print("Validated {} of {} workflows in {:.2f}s, the rest were cached".format(validated, len(folders), time.time() - start))
+		sys.exit(0 if valid else 1)
+
+	if len(args) != 1:
+		usage()
+		sys.exit(2)
+
+	folder = args[0]
+	workflow = Workflow(folder + "/flow.xml", folder + "/binding.xml",folder + "/tool.xml", verbose = verbose)
 	workflow.validate() == True
 
 	workflow.printerrors();